@@ -1,42 +1,769 @@
 import sys
 import os
+import gc
 import math
-from itertools import permutations
+import mmap
+import time
+import random
+import signal
+import json
+import argparse
+import asyncio
+import cProfile
+import platform
+import tracemalloc
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+try:
+    import numpy as np
+except ImportError:
+    # only the batch evaluator uses numpy, it falls back to plain python
+    np = None
+
+# the standard board is 4x4, every cell is one bit of a 16 bit mask
+# Board builds the same tables for 5x5, 6x6, ... boards
+BOARD_SIZE = 4
+# score for a won game, the remaining depth is added so quicker wins score higher
+WIN_SCORE = 1000
+# deepest iteration the time limited search will start
+MAX_SEARCH_DEPTH = 32
+# how many nodes are searched between two looks at the clock
+TIME_CHECK_NODES = 64
+# part of the time limit kept back for unwinding the search and returning the move
+TIME_MARGIN = 0.15
+# boards up to this many cells count placements with one table entry per blocked mask
+MOBILITY_TABLE_CELLS = 16
+# bigger boards count placements a chunk of this many cells at a time
+COUNTER_CHUNK_BITS = 13
+COUNTER_CHUNK_MASK = (1 << COUNTER_CHUNK_BITS) - 1
+# the canonical hash memo is emptied when it grows past this, big boards have too many positions to keep
+CANONICAL_HASH_LIMIT = 1 << 20
+
+
+class SearchTimeout(Exception):
+    # raised inside the search when the time for a move has run out
+    pass
+
+
+def genLShapes():
+    # all 8 rotations and reflections of the l piece, anchored at the top left
+    base = [(0, 0), (1, 0), (2, 0), (2, 1)]
+    shapes = []
+    for flip in (1, -1):
+        cells = [(x, y * flip) for x, y in base]
+        for _ in range(4):
+            cells = [(y, -x) for x, y in cells]
+            minX = min(x for x, _ in cells)
+            minY = min(y for _, y in cells)
+            shape = sorted((x - minX, y - minY) for x, y in cells)
+            if shape not in shapes:
+                shapes.append(shape)
+    return shapes
+
+
+L_SHAPES = genLShapes()
+
+
+class PlacementCounter:
+    # number of l placements clear of a blocked mask, for boards too big for a table
+    # each chunk of the mask picks a bitset of the placements its cells overlap
+    def __init__(self, masks, cellCount):
+        self.total = len(masks)
+        self.chunks = []
+        for shift in range(0, cellCount, COUNTER_CHUNK_BITS):
+            width = min(COUNTER_CHUNK_BITS, cellCount - shift)
+            cellHits = [sum(1 << i for i, mask in enumerate(masks) if mask >> (shift + bit) & 1) for bit in range(width)]
+            # every entry is a smaller entry plus its lowest cell
+            chunk = [0] * (1 << width)
+            for cells in range(1, 1 << width):
+                low = cells & -cells
+                chunk[cells] = chunk[cells ^ low] | cellHits[low.bit_length() - 1]
+            self.chunks.append(chunk)
+
+    def __getitem__(self, blocked):
+        hit = 0
+        for chunk in self.chunks:
+            hit |= chunk[blocked & COUNTER_CHUNK_MASK]
+            blocked >>= COUNTER_CHUNK_BITS
+        return self.total - bin(hit).count('1')
+
+
+class Board:
+    # everything that depends on the board size: placement tables, bitboard move
+    # generation, mobility counts, symmetries and zobrist keys
+    def __init__(self, size):
+        if size < 4:
+            raise ValueError("Board size must be at least 4")
+        self.size = size
+        self.cellCount = size * size
+        self.fullMask = (1 << self.cellCount) - 1
+        self.lPlacements = [tuple(cells) for cells in self.genLPlacements()]
+        self.lMasks = [self.cellsToMask(cells) for cells in self.lPlacements]
+        self.lIndex = {mask: i for i, mask in enumerate(self.lMasks)}
+        if self.cellCount <= MOBILITY_TABLE_CELLS:
+            self.mobility = self.genMobilityTable()
+        else:
+            self.mobility = PlacementCounter(self.lMasks, self.cellCount)
+        # placements covering the centre block the opponent most, so try them first
+        inner = range(size // 4, size - size // 4)
+        self.centreMask = self.cellsToMask([(x, y) for x in inner for y in inner])
+        self.lOrder = sorted(self.lMasks, key=lambda mask: -bin(mask & self.centreMask).count('1'))
+        # the 8 rotations and reflections of the board, each maps cell (x, y) to a new cell
+        last = size - 1
+        self.symmetries = [
+            lambda x, y: (x, y),
+            lambda x, y: (y, last - x),
+            lambda x, y: (last - x, last - y),
+            lambda x, y: (last - y, x),
+            lambda x, y: (x, last - y),
+            lambda x, y: (last - x, y),
+            lambda x, y: (y, x),
+            lambda x, y: (last - y, last - x),
+        ]
+        self.symmetryTables = self.genSymmetryTables()
+        self.inverseSymmetries = self.genInverseSymmetries()
+        # zobrist keys, the position hash is the xor of the keys for both l placements
+        # and both neutral cells, the side key is added when the table is probed
+        rng = random.Random(4)
+        self.zobristL1 = {mask: rng.getrandbits(64) for mask in self.lMasks}
+        self.zobristL2 = {mask: rng.getrandbits(64) for mask in self.lMasks}
+        self.zobristNeutral = {1 << i: rng.getrandbits(64) for i in range(self.cellCount)}
+        self.zobristSide = {'L1': 0, 'L2': rng.getrandbits(64)}
+        # zobrist hash of a position -> (hash of its canonical form, symmetry that gives it)
+        # shared by every game on this board size
+        self.canonicalHashes = {}
+
+    def cellBit(self, x, y):
+        # bit used for a single cell
+        return 1 << (x * self.size + y)
+
+    def cellsToMask(self, positions):
+        # turn a list of cells into an occupancy mask
+        mask = 0
+        for x, y in positions:
+            mask |= 1 << (x * self.size + y)
+        return mask
+
+    def genLPlacements(self):
+        # every way an l piece fits on the empty board
+        placements = []
+        for i in range(self.size):
+            for j in range(self.size):
+                for shape in L_SHAPES:
+                    cells = [(i + dx, j + dy) for dx, dy in shape]
+                    if all(0 <= x < self.size and 0 <= y < self.size for x, y in cells):
+                        placements.append(cells)
+        return placements
+
+    def genMobilityTable(self):
+        # number of l placements that fit around every possible set of blocked cells
+        # each placement is added to every blocked mask that leaves its cells free
+        table = bytearray(self.fullMask + 1)
+        for mask in self.lMasks:
+            free = self.fullMask & ~mask
+            blocked = free
+            while True:
+                table[blocked] += 1
+                if not blocked:
+                    break
+                blocked = (blocked - 1) & free
+        return table
+
+    def legalPlacementMasks(self, ownMask, blocked):
+        # every l placement that avoids the blocked cells and is not the current one
+        return [mask for mask in self.lMasks if not mask & blocked and mask != ownMask]
+
+    def countLegalPlacements(self, ownMask, blocked):
+        # how many placements legalPlacementMasks would return
+        count = self.mobility[blocked]
+        if ownMask in self.lIndex and not ownMask & blocked:
+            count -= 1
+        return count
+
+    def iterPlacementMasks(self, ownMask, blocked, first=None):
+        # legalPlacementMasks as a generator in lOrder, first (when legal) comes first
+        # nothing more is generated once the caller stops asking
+        if first is not None and first != ownMask and not first & blocked:
+            yield first
+        for mask in self.lOrder:
+            if not mask & blocked and mask != ownMask and mask != first:
+                yield mask
+
+    def isFullMoveLegal(self, ownMask, oppMask, neutralMask, move):
+        # whether (l mask, new neutral mask) can be played, without generating the moves
+        lMask, newNeutrals = move
+        if lMask == ownMask or lMask not in self.lIndex or lMask & (oppMask | neutralMask):
+            return False
+        if newNeutrals == neutralMask:
+            return True
+        fromBit = neutralMask & ~newNeutrals
+        toBit = newNeutrals & ~neutralMask
+        # exactly one neutral piece moved, onto a cell neither l covers
+        return (fromBit and not fromBit & (fromBit - 1) and toBit and not toBit & (toBit - 1)
+                and not toBit & (lMask | oppMask))
+
+    def genFullMoves(self, ownMask, oppMask, neutralMask):
+        # every l placement, each followed by no neutral move or one neutral relocation
+        # a move is the pair (new l mask, new neutral mask)
+        moves = []
+        for lMask in self.legalPlacementMasks(ownMask, oppMask | neutralMask):
+            moves.append((lMask, neutralMask))
+            free = self.fullMask & ~(lMask | oppMask | neutralMask)
+            pieces = neutralMask
+            while pieces:
+                fromBit = pieces & -pieces
+                pieces ^= fromBit
+                rest = neutralMask ^ fromBit
+                targets = free
+                while targets:
+                    toBit = targets & -targets
+                    targets ^= toBit
+                    moves.append((lMask, rest | toBit))
+        return moves
+
+    def iterFullMoves(self, ownMask, oppMask, neutralMask):
+        # genFullMoves as a generator, same order, nothing is built past what the caller takes
+        blocked = oppMask | neutralMask
+        for lMask in self.lMasks:
+            if lMask & blocked or lMask == ownMask:
+                continue
+            yield lMask, neutralMask
+            free = self.fullMask & ~(lMask | blocked)
+            pieces = neutralMask
+            while pieces:
+                fromBit = pieces & -pieces
+                pieces ^= fromBit
+                rest = neutralMask ^ fromBit
+                targets = free
+                while targets:
+                    toBit = targets & -targets
+                    targets ^= toBit
+                    yield lMask, rest | toBit
+
+    def genSymmetryTables(self):
+        # for every symmetry one lookup table per byte of the mask
+        tables = []
+        for symmetry in self.symmetries:
+            chunks = []
+            for shift in range(0, self.cellCount, 8):
+                chunk = []
+                for byte in range(256):
+                    mask = 0
+                    for bit in range(8):
+                        cell = shift + bit
+                        if byte >> bit & 1 and cell < self.cellCount:
+                            mask |= self.cellBit(*symmetry(*divmod(cell, self.size)))
+                    chunk.append(mask)
+                chunks.append(chunk)
+            tables.append(chunks)
+        return tables
+
+    def transformMask(self, t, mask):
+        # apply symmetry t to every cell of a mask
+        result = 0
+        for chunk in self.symmetryTables[t]:
+            result |= chunk[mask & 255]
+            mask >>= 8
+        return result
+
+    def genInverseSymmetries(self):
+        # symmetry that undoes each symmetry
+        probe = self.cellBit(0, 1) | self.cellBit(0, 2) | self.cellBit(1, 0)
+        return [next(u for u in range(len(self.symmetries)) if self.transformMask(u, self.transformMask(t, probe)) == probe)
+                for t in range(len(self.symmetries))]
+
+    def transformCells(self, t, positions):
+        # apply symmetry t to a list of cells
+        return [self.symmetries[t](x, y) for x, y in positions]
+
+    def transformFullMove(self, t, move):
+        # apply symmetry t to an (l mask, neutral mask) move
+        return self.transformMask(t, move[0]), self.transformMask(t, move[1])
+
+    def canonicalPosition(self, firstMask, secondMask, neutralMask):
+        # smallest image of the position under the 8 symmetries, and the symmetry that gives it
+        best = None
+        bestT = 0
+        for t in range(len(self.symmetries)):
+            image = (self.transformMask(t, firstMask), self.transformMask(t, secondMask), self.transformMask(t, neutralMask))
+            if best is None or image < best:
+                best = image
+                bestT = t
+        return best, bestT
+
+    def zobristHash(self, p1Mask, p2Mask, neutralMask):
+        # hash of a position from scratch, search keeps it up to date incrementally
+        h = self.zobristL1.get(p1Mask, 0) ^ self.zobristL2.get(p2Mask, 0)
+        while neutralMask:
+            bit = neutralMask & -neutralMask
+            neutralMask ^= bit
+            h ^= self.zobristNeutral[bit]
+        return h
+
+    def canonicalHash(self, h, p1Mask, p2Mask, neutralMask):
+        # hash all 8 mirrored versions of a position share, h is the position's own hash
+        entry = self.canonicalHashes.get(h)
+        if entry is None:
+            (c1, c2, cn), t = self.canonicalPosition(p1Mask, p2Mask, neutralMask)
+            entry = (self.zobristHash(c1, c2, cn), t)
+            if len(self.canonicalHashes) >= CANONICAL_HASH_LIMIT:
+                self.canonicalHashes.clear()
+            self.canonicalHashes[h] = entry
+        return entry
+
+
+BOARDS = {}
+
+
+def getBoard(size):
+    # tables for a board size, built once and shared by every game of that size
+    if size not in BOARDS:
+        BOARDS[size] = Board(size)
+    return BOARDS[size]
+
+
+# the standard board, the tablebase, Position, the batch evaluator, game records
+# and the engine protocol all work on it through the names below
+BOARD = getBoard(BOARD_SIZE)
+FULL_MASK = BOARD.fullMask
+cellBit = BOARD.cellBit
+cellsToMask = BOARD.cellsToMask
+L_PLACEMENTS = BOARD.lPlacements
+L_MASKS = BOARD.lMasks
+L_INDEX = BOARD.lIndex
+MOBILITY = BOARD.mobility
+SYMMETRIES = BOARD.symmetries
+countLegalPlacements = BOARD.countLegalPlacements
+isFullMoveLegal = BOARD.isFullMoveLegal
+genFullMoves = BOARD.genFullMoves
+transformMask = BOARD.transformMask
+canonicalPosition = BOARD.canonicalPosition
+# the two neutral pieces together, as one of the 120 pairs of cells
+NEUTRAL_PAIRS = [cellBit(a // BOARD_SIZE, a % BOARD_SIZE) | cellBit(b // BOARD_SIZE, b % BOARD_SIZE)
+                 for a in range(BOARD_SIZE * BOARD_SIZE) for b in range(a + 1, BOARD_SIZE * BOARD_SIZE)]
+NEUTRAL_INDEX = {mask: i for i, mask in enumerate(NEUTRAL_PAIRS)}
+# canonical l placement of each symmetry class, the first mask of a canonical position is one of these
+CANONICAL_L = sorted({min(transformMask(t, mask) for t in range(len(SYMMETRIES))) for mask in L_MASKS})
+CANONICAL_L_INDEX = {mask: i for i, mask in enumerate(CANONICAL_L)}
+
+
+# bound stored with each transposition table value
+BOUND_EXACT = 0
+BOUND_LOWER = 1
+BOUND_UPPER = 2
+
+
+def scoreToTable(value, depth):
+    # win scores include the remaining depth, store them relative to this node
+    if value >= WIN_SCORE:
+        return value - depth
+    if value <= -WIN_SCORE:
+        return value + depth
+    return value
+
+
+def scoreFromTable(value, depth):
+    # undo scoreToTable for a node searched with depth
+    if value >= WIN_SCORE - 64:
+        return value + depth
+    if value <= -(WIN_SCORE - 64):
+        return value - depth
+    return value
+
+
+class TranspositionTable:
+    def __init__(self, size=1 << 16):
+        # fixed number of slots (rounded up to a power of two) so memory stays flat
+        self.size = 1 << max(0, (size - 1).bit_length())
+        self.slotMask = self.size - 1
+        self.keys = [None] * self.size
+        self.depths = [0] * self.size
+        self.values = [0] * self.size
+        self.flags = [0] * self.size
+        self.moves = [None] * self.size
+        self.ages = [0] * self.size
+        self.age = 0
+        self.probes = 0
+        self.hits = 0
+        self.collisions = 0
+        self.stores = 0
+        self.replacements = 0
+
+    def newSearch(self):
+        # entries from older searches are the first to be replaced
+        self.age += 1
+
+    def probe(self, key):
+        # (depth, value, flag, move) for key, None if it is not stored
+        self.probes += 1
+        slot = key & self.slotMask
+        stored = self.keys[slot]
+        if stored == key:
+            self.hits += 1
+            return self.depths[slot], self.values[slot], self.flags[slot], self.moves[slot]
+        if stored is not None:
+            self.collisions += 1
+        return None
+
+    def store(self, key, depth, value, flag, move):
+        # depth preferred replacement, a deeper entry from this search is kept
+        slot = key & self.slotMask
+        stored = self.keys[slot]
+        if stored is not None:
+            if self.ages[slot] == self.age and self.depths[slot] > depth:
+                return
+            if stored != key:
+                self.replacements += 1
+        self.stores += 1
+        self.keys[slot] = key
+        self.depths[slot] = depth
+        self.values[slot] = value
+        self.flags[slot] = flag
+        self.moves[slot] = move
+        self.ages[slot] = self.age
+
+    def clear(self):
+        # drop every entry but keep the slots
+        self.keys = [None] * self.size
+        self.moves = [None] * self.size
+
+    def stats(self):
+        # counters for tuning the table size
+        used = self.size - self.keys.count(None)
+        return {
+            'size': self.size,
+            'used': used,
+            'probes': self.probes,
+            'hits': self.hits,
+            'hitRate': self.hits / self.probes if self.probes else 0.0,
+            'collisions': self.collisions,
+            'stores': self.stores,
+            'replacements': self.replacements,
+        }
+
+
+def boundFlag(value, alpha, beta):
+    # what a fail soft alpha beta value tells us about the true score
+    if value <= alpha:
+        return BOUND_UPPER
+    if value >= beta:
+        return BOUND_LOWER
+    return BOUND_EXACT
+
+
+class SearchStats:
+    # what one move's search did, filled in by LGame.chooseAiMoveMinimax
+    # the timing split is only measured when LGame.collectStats is on
+    def __init__(self, source=None):
+        self.source = source
+        self.seconds = 0.0
+        self.nodes = 0
+        self.cutoffs = 0
+        self.cacheProbes = 0
+        self.cacheHits = 0
+        self.cacheCollisions = 0
+        self.completedDepth = 0
+        self.timedOut = False
+        # (depth, seconds, nodes) for every finished iteration of the full search
+        self.depths = []
+        self.moveGenSeconds = None
+        self.orderSeconds = None
+        self.evalSeconds = None
+
+    def cacheHitRate(self):
+        return self.cacheHits / self.cacheProbes if self.cacheProbes else 0.0
+
+    def asDict(self):
+        return {
+            'source': self.source,
+            'seconds': round(self.seconds, 6),
+            'nodes': self.nodes,
+            'nps': round(self.nodes / self.seconds) if self.seconds else 0,
+            'cutoffs': self.cutoffs,
+            'cacheProbes': self.cacheProbes,
+            'cacheHits': self.cacheHits,
+            'cacheHitRate': round(self.cacheHitRate(), 4),
+            'cacheCollisions': self.cacheCollisions,
+            'completedDepth': self.completedDepth,
+            'timedOut': self.timedOut,
+            'depths': [{'depth': d, 'seconds': round(s, 6), 'nodes': n} for d, s, n in self.depths],
+            'moveGenSeconds': None if self.moveGenSeconds is None else round(self.moveGenSeconds, 6),
+            'orderSeconds': None if self.orderSeconds is None else round(self.orderSeconds, 6),
+            'evalSeconds': None if self.evalSeconds is None else round(self.evalSeconds, 6),
+        }
+
+
+def orientationCells(x, y, orientation):
+    # the two cell lists an l typed as corner + orientation can mean, None for a bad orientation
+    if orientation == 'n':
+        return [(x-1, y-1), (x, y-1), (x, y), (x-1, y)], [(x-1, y), (x, y), (x, y+1), (x, y+2)]
+    if orientation == 's':
+        return [(x, y-2), (x, y-1), (x, y), (x+1, y)], [(x+1, y), (x, y), (x, y+1), (x, y+2)]
+    if orientation == 'e':
+        return [(x-2, y), (x-1, y), (x, y), (x, y+1)], [(x+1, y), (x+2, y), (x, y), (x, y+1)]
+    if orientation == 'w':
+        return [(x, y-1), (x, y), (x+1, y-1), (x+1, y)], [(x, y-1), (x, y), (x+1, y), (x+2, y)]
+    return None
+
+
+def placementFromInput(x, y, orientation, blocked, board=BOARD):
+    # mask of the first candidate l that is on the board and clear of blocked
+    candidates = orientationCells(x, y, orientation)
+    if candidates is None:
+        raise ValueError("Unknown orientation")
+    for cells in candidates:
+        if all(0 <= cx < board.size and 0 <= cy < board.size for cx, cy in cells):
+            mask = board.cellsToMask(cells)
+            if mask in board.lIndex and not mask & blocked:
+                return mask
+    raise ValueError("Invalid L Coordinates")
+
+
+def parseInitialState(input_str, board=BOARD):
+    # 'l1y l1x l1o n1y n1x n2y n2x l2y l2x l2o' (1-indexed, same as editInitialState)
+    # to (p1Mask, p2Mask, neutralMask), raises ValueError when it is not a legal layout
+    parts = input_str.split()
+    if len(parts) != 10:
+        raise ValueError("Invalid Format")
+    try:
+        l1y, l1x, n1y, n1x, n2y, n2x, l2y, l2x = [int(parts[i]) - 1 for i in (0, 1, 3, 4, 5, 6, 7, 8)]
+    except ValueError:
+        raise ValueError("Invalid Format")
+    p1Mask = placementFromInput(l1x, l1y, parts[2].lower(), 0, board)
+    p2Mask = placementFromInput(l2x, l2y, parts[9].lower(), p1Mask, board)
+    neutralMask = 0
+    for x, y in ((n1x, n1y), (n2x, n2y)):
+        if not (0 <= x < board.size and 0 <= y < board.size) or board.cellBit(x, y) & (p1Mask | p2Mask | neutralMask):
+            raise ValueError("Invalid Neutral Coordinates")
+        neutralMask |= board.cellBit(x, y)
+    return p1Mask, p2Mask, neutralMask
+
+
+# a position packed into 20 bits: l1 placement index, l2 placement index,
+# neutral pair index and the side to move
+POSITION_L2_SHIFT = 6
+POSITION_NEUTRAL_SHIFT = 12
+POSITION_SIDE_SHIFT = 19
+# dense ranks: the l pairs that do not overlap, and the neutral pairs that fit
+# around them (always 2 out of the same number of free cells)
+L_PAIRS = [(i, j) for i, first in enumerate(L_MASKS) for j, second in enumerate(L_MASKS) if not first & second]
+L_PAIR_RANK = {pair: rank for rank, pair in enumerate(L_PAIRS)}
+FREE_CELLS = BOARD_SIZE * BOARD_SIZE - 8
+NEUTRAL_PLACEMENTS = FREE_CELLS * (FREE_CELLS - 1) // 2
+POSITION_COUNT = len(L_PAIRS) * NEUTRAL_PLACEMENTS * 2
+
+
+class Position:
+    # immutable game position, hashes and compares as one small int
+    __slots__ = ('packed',)
+
+    def __init__(self, packed):
+        object.__setattr__(self, 'packed', packed)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Position is immutable")
+
+    def __reduce__(self):
+        return Position, (self.packed,)
+
+    @classmethod
+    def fromMasks(cls, p1Mask, p2Mask, neutralMask, player):
+        if p1Mask not in L_INDEX or p2Mask not in L_INDEX or neutralMask not in NEUTRAL_INDEX \
+                or p1Mask & p2Mask or neutralMask & (p1Mask | p2Mask):
+            raise ValueError("Invalid Position")
+        return cls(L_INDEX[p1Mask] | L_INDEX[p2Mask] << POSITION_L2_SHIFT
+                   | NEUTRAL_INDEX[neutralMask] << POSITION_NEUTRAL_SHIFT
+                   | (player == 'L2') << POSITION_SIDE_SHIFT)
+
+    @classmethod
+    def unrank(cls, rank):
+        # inverse of rank(), every 0 <= rank < POSITION_COUNT is a legal position
+        if not 0 <= rank < POSITION_COUNT:
+            raise ValueError("Invalid Position Rank")
+        rank, side = divmod(rank, 2)
+        pairRank, combination = divmod(rank, NEUTRAL_PLACEMENTS)
+        p1Index, p2Index = L_PAIRS[pairRank]
+        free = FULL_MASK & ~(L_MASKS[p1Index] | L_MASKS[p2Index])
+        cells = [1 << bit for bit in range(BOARD_SIZE * BOARD_SIZE) if free >> bit & 1]
+        # combination numbers pairs a < b of free cells as b * (b - 1) / 2 + a
+        b = 1
+        while (b + 1) * b // 2 <= combination:
+            b += 1
+        a = combination - b * (b - 1) // 2
+        return cls(p1Index | p2Index << POSITION_L2_SHIFT
+                   | NEUTRAL_INDEX[cells[a] | cells[b]] << POSITION_NEUTRAL_SHIFT
+                   | side << POSITION_SIDE_SHIFT)
+
+    @property
+    def p1Mask(self):
+        return L_MASKS[self.packed & 63]
+
+    @property
+    def p2Mask(self):
+        return L_MASKS[self.packed >> POSITION_L2_SHIFT & 63]
+
+    @property
+    def neutralMask(self):
+        return NEUTRAL_PAIRS[self.packed >> POSITION_NEUTRAL_SHIFT & 127]
+
+    @property
+    def player(self):
+        return 'L2' if self.packed >> POSITION_SIDE_SHIFT else 'L1'
+
+    def masks(self):
+        # (p1Mask, p2Mask, neutralMask, player), what setPositionMasks takes
+        return self.p1Mask, self.p2Mask, self.neutralMask, self.player
+
+    def rank(self):
+        # dense index in 0 .. POSITION_COUNT - 1, for arrays indexed by position
+        pairRank = L_PAIR_RANK[(self.packed & 63, self.packed >> POSITION_L2_SHIFT & 63)]
+        neutralMask = self.neutralMask
+        free = FULL_MASK & ~(self.p1Mask | self.p2Mask)
+        low = neutralMask & -neutralMask
+        high = neutralMask & ~low
+        a = bin(free & (low - 1)).count('1')
+        b = bin(free & (high - 1)).count('1')
+        return ((pairRank * NEUTRAL_PLACEMENTS + b * (b - 1) // 2 + a) << 1) | self.packed >> POSITION_SIDE_SHIFT
+
+    def __eq__(self, other):
+        return isinstance(other, Position) and self.packed == other.packed
+
+    def __hash__(self):
+        return hash(self.packed)
+
+    def __repr__(self):
+        return f"Position({self.packed:#x})"
+
+
+def greedyNeutralMask(p1Mask, p2Mask, neutralMask, player):
+    # neutral mask after the neutral move chooseAiNeutralMove picks for player:
+    # the first one, in piece then cell order, that leaves the opponent fewest l moves
+    ownMask = p1Mask if player == 'L1' else p2Mask
+    occupied = p1Mask | p2Mask | neutralMask
+    low = neutralMask & -neutralMask
+    bestMask = neutralMask
+    bestCount = MOBILITY[ownMask | neutralMask]
+    for other in (neutralMask & ~low, low):
+        for cell in range(BOARD_SIZE * BOARD_SIZE):
+            if not occupied >> cell & 1:
+                count = MOBILITY[ownMask | other | 1 << cell]
+                if count < bestCount:
+                    bestCount = count
+                    bestMask = other | 1 << cell
+    return bestMask
+
+
+if np is not None:
+    MOBILITY_ARRAY = np.frombuffer(bytes(MOBILITY), dtype=np.uint8)
+    L_MASK_ARRAY = np.array(L_MASKS, dtype=np.int64)
+    NEUTRAL_PAIR_ARRAY = np.array(NEUTRAL_PAIRS, dtype=np.int64)
+    CELL_BIT_ARRAY = np.int64(1) << np.arange(BOARD_SIZE * BOARD_SIZE, dtype=np.int64)
+
+
+def evaluateBatch(positions, neutralAware=False):
+    # heuristicEvaluation for many Position.packed values at once, a numpy array
+    # (a list without numpy) in the same order
+    # neutralAware scores each position after the side to move's greedy neutral move
+    if np is None:
+        scores = []
+        for packed in positions:
+            p1Mask, p2Mask, neutralMask, player = Position(packed).masks()
+            if neutralAware:
+                neutralMask = greedyNeutralMask(p1Mask, p2Mask, neutralMask, player)
+            scores.append(MOBILITY[p1Mask | neutralMask] - MOBILITY[p2Mask | neutralMask])
+        return scores
+    packed = np.asarray(positions, dtype=np.int64)
+    p1Mask = L_MASK_ARRAY[packed & 63]
+    p2Mask = L_MASK_ARRAY[packed >> POSITION_L2_SHIFT & 63]
+    neutralMask = NEUTRAL_PAIR_ARRAY[packed >> POSITION_NEUTRAL_SHIFT & 127]
+    if neutralAware:
+        ownMask = np.where(packed >> POSITION_SIDE_SHIFT & 1, p2Mask, p1Mask)
+        low = neutralMask & -neutralMask
+        free = ((p1Mask | p2Mask | neutralMask)[:, None] & CELL_BIT_ARRAY) == 0
+        # one row per position: no move, then the high piece kept with the low
+        # one moved to each cell, then the other way round, as greedyNeutralMask tries them
+        candidates = np.concatenate([neutralMask[:, None],
+                                     (neutralMask & ~low)[:, None] | CELL_BIT_ARRAY,
+                                     low[:, None] | CELL_BIT_ARRAY], axis=1)
+        valid = np.concatenate([np.ones((len(packed), 1), dtype=bool), free, free], axis=1)
+        counts = np.where(valid, MOBILITY_ARRAY[ownMask[:, None] | candidates], 255)
+        neutralMask = candidates[np.arange(len(packed)), counts.argmin(axis=1)]
+    return MOBILITY_ARRAY[p1Mask | neutralMask].astype(np.int16) - MOBILITY_ARRAY[p2Mask | neutralMask]
+
 
 class LGame:
-    def __init__(self):
-        # this sets up a 4x4 grid filled with 0
-        self.grid = [['0' for _ in range(4)] for _ in range(4)]
+    def __init__(self, cacheSize=1 << 16, workers=1, size=BOARD_SIZE):
+        # placement tables, move generation and hashing for this board size
+        self.board = getBoard(size)
+        last = size - 1
+        # this sets up a size x size grid filled with 0
+        self.grid = [['0' for _ in range(size)] for _ in range(size)]
+        # one occupancy mask per piece, kept in sync with the grid
+        self.p1Mask = 0
+        self.p2Mask = 0
+        self.neutralMask = 0
         # this is where player 1 starts
         self.p1Pos = [(0, 0), (0, 1), (0, 2), (1, 0)]
         # place player 1's piece on the board
         self.placePiece(self.p1Pos, 'L1')
         # this is where player 2 starts
-        self.p2Pos = [(3, 3), (3, 2), (3, 1), (2, 3)]
+        self.p2Pos = [(last, last), (last, last - 1), (last, last - 2), (last - 1, last)]
         # place player 2's piece on the board
         self.placePiece(self.p2Pos, 'L2')
         # neutral pieces start here
-        self.neutralPieces = [(1, 1), (2, 2)]
+        self.neutralPieces = [(1, 1), (last - 1, last - 1)]
         # place neutral pieces on the board
         self.placeNeutralPieces()
-        # these are different shapes of the l piece
-        self.lPositions = {
-            'N': [(0, 0), (1, 0), (2, 0), (2, 1)],
-            'NM': [(0, 1), (1, 1), (2, 1), (2, 0)],
-            'E': [(0, 0), (0, 1), (0, 2), (1, 0)],
-            'EM': [(0, 0), (0, 1), (0, 2), (1, 2)],
-            'S': [(0, 1), (0, 0), (1, 1), (2, 1)],
-            'SM': [(0, 0), (1, 0), (2, 0), (2, -1)],
-            'W': [(0, 2), (1, 0), (1, 1), (1, 2)],
-            'WM': [(0, 0), (1, 0), (1, 1), (1, 2)],
-        }
         # start with player 1
         self.currentPlayer = 'L1'
         self.p1Type = None
         self.p2Type = None
         self.aiDepth = None
-        # cache for storing states
-        self.cache = {}
+        # transposition table for the search, fixed size
+        self.cache = TranspositionTable(cacheSize)
+        # separate table for the two stage search, its plies mean something else
+        self.twoStageCache = TranspositionTable(cacheSize)
+        # zobrist hash of the masks, only kept up to date during a search
+        self.hash = 0
+        # solved positions, None until lgame.tb has been generated, it only covers 4x4
+        self.tablebase = loadTablebase() if size == BOARD_SIZE else None
+        # neutral move picked together with the l move by the tablebase or full search
+        self.hasNeutralPlan = False
+        self.neutralPlan = None
+        # 'full' searches l move plus neutral move as one ply, 'twostage' searches
+        # l moves only and picks the neutral move greedily afterwards
+        self.searchMode = 'full'
+        # nodes visited by the searches
+        self.nodes = 0
+        # seconds the ai may think per move, None searches the full depth every time
+        self.timeLimit = None
+        self.deadline = None
+        # move ordering state for the full search
+        self.rootDepth = 0
+        self.completedDepth = 0
+        self.pv = []
+        self.killers = []
+        self.history = {'L1': {}, 'L2': {}}
+        # scores of the root moves searched so far in the current iteration
+        self.rootScores = {}
+        # what makeGameMove changed, newest last
+        self.undoStack = []
+        # processes the full search splits its root moves over, the pool is
+        # started on the first deep search and kept until close()
+        self.workers = workers
+        # (l mask, neutral mask) the last full search picked, and its value at the
+        # deepest completed iteration (None when not even depth 1 finished)
+        self.bestFullMove = None
+        self.bestFullValue = None
+        self.pool = None
+        # cutoffs seen by the searches, and what the last ai move's search did
+        self.cutoffs = 0
+        self.lastSearchStats = SearchStats()
+        # time move generation, ordering and evaluation separately, this costs
+        # a clock read per call so it is off unless asked for
+        self.collectStats = False
+        # when set, the next ai move is searched under cProfile and dumped here
+        self.profilePath = None
 
     def clearScreen(self):
         # clear the screen
@@ -45,7 +772,7 @@ class LGame:
     def isValidMove(self, positions):
         # check if all positions are on board and empty
         for x, y in positions:
-            if not (0 <= x < 4 and 0 <= y < 4):
+            if not (0 <= x < self.board.size and 0 <= y < self.board.size):
                 return False
             if self.grid[x][y] != '0':
                 return False
@@ -53,50 +780,97 @@ class LGame:
 
     def genLegalMoves(self, player):
         # generate all moves that player can do
-        currPos = self.p1Pos if player == 'L1' else self.p2Pos
-        # remove player piece first
-        for x, y in currPos:
-            self.grid[x][y] = '0'
-        legalMoves = []
-        # try placing l piece in different spots
-        for i in range(4):
-            for j in range(4):
-                for pos in self.lPositions.values():
-                    newPos = [(i + dx, j + dy) for dx, dy in pos]
-                    if self.isValidMove(newPos):
-                        legalMoves.append(newPos)
-        # remove any moves that are same as current position
-        currPosPermutations = list(permutations(currPos))
-        legalMoves = [
-            move for move in legalMoves
-            if tuple(sorted(move)) not in map(tuple, map(sorted, currPosPermutations))
-        ]
-        # put player piece back
-        for x, y in currPos:
-            self.grid[x][y] = player
-        return legalMoves
+        ownMask, blocked = self.playerMasks(player)
+        return [list(self.board.lPlacements[self.board.lIndex[mask]]) for mask in self.board.legalPlacementMasks(ownMask, blocked)]
+
+    def playerMasks(self, player):
+        # mask of the player's own piece and of every cell blocked for it
+        if player == 'L1':
+            return self.p1Mask, self.p2Mask | self.neutralMask
+        return self.p2Mask, self.p1Mask | self.neutralMask
+
+    def hasLegalMove(self, player):
+        # whether the player can move at all, no moves are generated
+        ownMask, blocked = self.playerMasks(player)
+        return self.board.countLegalPlacements(ownMask, blocked) > 0
+
+    def iterPlacementMasks(self, player, first=None):
+        # l placements the player can move to, as masks, generated lazily
+        ownMask, blocked = self.playerMasks(player)
+        return self.board.iterPlacementMasks(ownMask, blocked, first)
+
+    def genPlayerFullMoves(self, player):
+        # l move plus neutral move pairs for the player
+        ownMask, blocked = self.playerMasks(player)
+        return self.board.genFullMoves(ownMask, blocked & ~self.neutralMask, self.neutralMask)
+
+    def iterPlayerFullMoves(self, player):
+        # genPlayerFullMoves as a generator, same order
+        ownMask, blocked = self.playerMasks(player)
+        return self.board.iterFullMoves(ownMask, blocked & ~self.neutralMask, self.neutralMask)
+
+    def setPositionMasks(self, p1Mask, p2Mask, neutralMask, player):
+        # set up the board from masks
+        self.grid = [['0' for _ in range(self.board.size)] for _ in range(self.board.size)]
+        self.p1Mask = 0
+        self.p2Mask = 0
+        self.neutralMask = 0
+        self.p1Pos = list(self.board.lPlacements[self.board.lIndex[p1Mask]])
+        self.placePiece(self.p1Pos, 'L1')
+        self.p2Pos = list(self.board.lPlacements[self.board.lIndex[p2Mask]])
+        self.placePiece(self.p2Pos, 'L2')
+        self.neutralPieces = [divmod(bit.bit_length() - 1, self.board.size) for bit in (neutralMask & -neutralMask, neutralMask & (neutralMask - 1))]
+        self.placeNeutralPieces()
+        self.currentPlayer = player
+
+    def toPosition(self):
+        # the current position as a Position, read from the masks
+        return Position.fromMasks(self.p1Mask, self.p2Mask, self.neutralMask, self.currentPlayer)
+
+    def setPosition(self, position):
+        # set up the board from a Position
+        self.setPositionMasks(*position.masks())
+
+    def canonicalPosition(self):
+        # canonical (p1Mask, p2Mask, neutralMask, player) of the current position and
+        # the symmetry that maps the board onto it
+        (p1Mask, p2Mask, neutralMask), t = self.board.canonicalPosition(self.board.cellsToMask(self.p1Pos), self.board.cellsToMask(self.p2Pos), self.board.cellsToMask(self.neutralPieces))
+        return (p1Mask, p2Mask, neutralMask, self.currentPlayer), t
+
+    def moveFromCanonical(self, move, t):
+        # map an l move found on the canonical board back onto this board
+        return self.board.transformCells(self.board.inverseSymmetries[t], move)
 
     def placePiece(self, positions, player):
         # place a piece on the board
         for x, y in positions:
             self.grid[x][y] = player
+        if player == 'L1':
+            self.p1Mask |= self.board.cellsToMask(positions)
+        elif player == 'L2':
+            self.p2Mask |= self.board.cellsToMask(positions)
 
     def removePiece(self, positions):
         # remove a piece from the board
         for x, y in positions:
             self.grid[x][y] = '0'
+        mask = self.board.cellsToMask(positions)
+        self.p1Mask &= ~mask
+        self.p2Mask &= ~mask
+        self.neutralMask &= ~mask
 
     def placeNeutralPieces(self):
         # place the two neutral pieces
         for x, y in self.neutralPieces:
             self.grid[x][y] = 'N'
+        self.neutralMask |= self.board.cellsToMask(self.neutralPieces)
 
     def printGrid(self):
         # show the board
         self.clearScreen()
         for row in self.grid:
             print(" | ".join(f"{cell:2}" for cell in row))
-            print("-" * 17)
+            print("-" * (5 * self.board.size - 3))
 
     def parseInput(self, input_str):
         # parse the move that user types
@@ -129,11 +903,11 @@ class LGame:
         
         if len(parts) == 7:
             # check if neutral piece move is valid
-            if initial_nx < 0 or initial_nx >= 4 or initial_ny < 0 or initial_ny >= 4 or self.grid[initial_nx][initial_ny] != 'N':
+            if not (0 <= initial_nx < self.board.size and 0 <= initial_ny < self.board.size) or self.grid[initial_nx][initial_ny] != 'N':
                 print("Invalid Initial Neutral Coordinates")
                 return None, None
             
-            if final_nx < 0 or final_nx >= 4 or final_ny < 0 or final_ny >= 4:
+            if not (0 <= final_nx < self.board.size and 0 <= final_ny < self.board.size):
                 print("Invalid Final Neutral Coordinates")
                 return None, None
 
@@ -165,94 +939,13 @@ class LGame:
 
     def editInitialState(self, input_str):
         # change the starting layout based on user input
-        initial_parts = input_str.split()
-        self.p1Pos = []
-        self.p2Pos = []
-        self.grid = [['0' for _ in range(4)] for _ in range(4)]
-        self.printGrid()
-
-        
-        if len(initial_parts) != 10:
-            print("Invalid Format")
+        try:
+            p1Mask, p2Mask, neutralMask = parseInitialState(input_str, self.board)
+        except ValueError as error:
+            print(error)
             return None
-        
-        neutral_x1, neutral_y1 = 0, 0
-        neutral_x2, neutral_y2 = 0, 0
-
-        l1x, l1y = int(initial_parts[1]) - 1, int(initial_parts[0]) - 1
-        l1_orientation = initial_parts[2].lower()
-
-        l2x, l2y = int(initial_parts[8]) - 1, int(initial_parts[7]) - 1
-        l2_orientation = initial_parts[9].lower()
-
-        neutral_x1, neutral_y1 = int(initial_parts[4]) - 1, int(initial_parts[3]) - 1
-        neutral_x2, neutral_y2 = int(initial_parts[6]) - 1, int(initial_parts[5]) - 1
-
-        if l1_orientation == 'n':
-            valid_moves = [(l1x-1, l1y-1), (l1x, l1y-1), (l1x, l1y), (l1x-1, l1y)]
-            valid_moves_mirrored = [(l1x-1, l1y), (l1x, l1y), (l1x, l1y+1), (l1x, l1y+2)]
-        elif l1_orientation =='s':
-            valid_moves = [(l1x, l1y-2), (l1x, l1y-1), (l1x, l1y), (l1x+1, l1y)]
-            valid_moves_mirrored = [(l1x+1, l1y), (l1x, l1y), (l1x, l1y+1), (l1x, l1y+2)]
-        elif l1_orientation == 'e':
-            valid_moves = [(l1x-2, l1y), (l1x-1, l1y), (l1x, l1y), (l1x, l1y+1)]
-            valid_moves_mirrored = [(l1x+1, l1y), (l1x+2, l1y), (l1x, l1y), (l1x, l1y+1)]
-        elif l1_orientation == 'w':
-            valid_moves = [(l1x, l1y-1), (l1x, l1y), (l1x+1, l1y-1), (l1x+1, l1y)]
-            valid_moves_mirrored = [(l1x, l1y-1), (l1x, l1y), (l1x+1, l1y), (l1x+2, l1y)]
-        else:
-            print(f"Unknown orientation")
-            return None, None
-        
-        legal_moves = self.genLegalMoves(self.currentPlayer)
-        valid_moves_set = set(valid_moves)
-        valid_moves_mirrored_set = set(valid_moves_mirrored)
-        legal_moves_sets = [set(move) for move in legal_moves]
-
-        if valid_moves_set in legal_moves_sets:
-            self.p1Pos = valid_moves_mirrored
-            self.placePiece(self.p1Pos, 'L1')
-        elif valid_moves_mirrored_set in legal_moves_sets:
-            self.p1Pos = valid_moves_mirrored
-            self.placePiece(self.p1Pos, 'L1')
-        
-
-        if l2_orientation== 'n':
-            valid_moves = [(l2x-1, l2y-1), (l2x, l2y-1), (l2x, l2y), (l2x-1, l2y)]
-            valid_moves_mirrored = [(l2x-1, l2y), (l2x, l2y), (l2x, l2y+1), (l2x, l2y+2)]
-        elif l2_orientation == 's':
-            valid_moves = [(l2x, l2y-2), (l2x, l2y-1), (l2x, l2y), (l2x+1, l2y)]
-            valid_moves_mirrored = [(l2x+1, l2y), (l2x, l2y), (l2x, l2y+1), (l2x, l2y+2)]
-        elif l2_orientation== 'e':
-            valid_moves = [(l2x-2, l2y), (l2x-1, l2y), (l2x, l2y), (l2x, l2y+1)]
-            valid_moves_mirrored = [(l2x+1, l2y), (l2x+2, l2y), (l2x, l2y), (l2x, l2y+1)]
-        elif l2_orientation == 'w':
-            valid_moves = [(l2x, l2y-1), (l2x, l2y), (l2x+1, l2y-1), (l2x+1, l2y)]
-            valid_moves_mirrored = [(l2x, l2y-1), (l2x, l2y), (l2x+1, l2y), (l2x+2, l2y)]
-        else:
-            print(f"Unknown orientation")
-            return None, None
-        
-        legal_moves = self.genLegalMoves(self.currentPlayer)
-        valid_moves_set = set(valid_moves)
-        valid_moves_mirrored_set = set(valid_moves_mirrored)
-        legal_moves_sets = [set(move) for move in legal_moves]
-
-        if valid_moves_set in legal_moves_sets:
-            self.p2Pos = valid_moves
-            self.placePiece(self.p2Pos, 'L2')
-        elif valid_moves_mirrored_set in legal_moves_sets:
-            self.p2Pos = valid_moves_mirrored 
-            self.placePiece(self.p2Pos, 'L2')
-        
-        if neutral_x1 < 0 or neutral_x1 >= 4 or neutral_y1 < 0 or neutral_y1 >= 4 or self.grid[neutral_x1][neutral_y1] != '0' or neutral_x2 < 0 or neutral_x2 >= 4 or neutral_y2 < 0 or neutral_y2 >= 4 or self.grid[neutral_x2][neutral_y2] != '0':
-            print("Invalid Neutral Coordinates")
-            return None, None
-        else: 
-            self.neutralPieces = [(neutral_x1, neutral_y1), (neutral_x2, neutral_y2)]
-            self.placeNeutralPieces()
-
-
+        self.setPositionMasks(p1Mask, p2Mask, neutralMask, self.currentPlayer)
+        self.printGrid()
 
     def startGame(self):
         # start the game loop
@@ -287,13 +980,17 @@ class LGame:
             self.currentPlayer = 'L1'
         if self.p1Type == 'ai' or self.p2Type == 'ai':
             d = input("Enter search depth (e.g. 3): ")
-            if d.isdigit():
+            if self.searchMode == 'full':
+                self.aiDepth = int(d) if d.isdigit() else 3
+            elif d.isdigit():
                 self.aiDepth = int(d) + 5
             else:
                 self.aiDepth = 10
+            t = input("Enter time limit per move in ms (empty for none): ")
+            if t.isdigit():
+                self.timeLimit = int(t) / 1000
         while True:
-            legalMoves = self.genLegalMoves(self.currentPlayer)
-            if len(legalMoves) <= 1:
+            if not self.hasLegalMove(self.currentPlayer):
                 winner = 'L2' if self.currentPlayer == 'L1' else 'L1'
                 print(f"No legal moves left for {self.currentPlayer}. {winner} wins!")
                 break
@@ -309,6 +1006,7 @@ class LGame:
                         return 0
                     chosenMove, chosenNeutralMove = self.parseInput(userInput)
             else:
+                legalMoves = self.genLegalMoves(self.currentPlayer)
                 chosenMove = self.chooseAiMoveMinimax(legalMoves, self.currentPlayer, self.aiDepth)
                 chosenNeutralMove = None
             self.makeMove(chosenMove)
@@ -319,13 +1017,48 @@ class LGame:
 
     def makeMove(self, newPositions):
         # make the chosen move
-        oldPositions = self.p1Pos if self.currentPlayer == 'L1' else self.p2Pos
-        self.removePiece(oldPositions)
-        self.placePiece(newPositions, self.currentPlayer)
-        if self.currentPlayer == 'L1':
-            self.p1Pos = newPositions
+        self.setLPiece(self.currentPlayer, newPositions)
+
+    def setLPiece(self, player, cells):
+        # move the player's l to cells, grid, list and mask together
+        oldCells = self.p1Pos if player == 'L1' else self.p2Pos
+        for x, y in oldCells:
+            self.grid[x][y] = '0'
+        for x, y in cells:
+            self.grid[x][y] = player
+        if player == 'L1':
+            self.p1Pos = cells
+            self.p1Mask = self.board.cellsToMask(cells)
         else:
-            self.p2Pos = newPositions
+            self.p2Pos = cells
+            self.p2Mask = self.board.cellsToMask(cells)
+        return oldCells
+
+    def setNeutralPiece(self, index, x, y):
+        # move one neutral piece, returns where it was
+        oldX, oldY = self.neutralPieces[index]
+        self.grid[oldX][oldY] = '0'
+        self.grid[x][y] = 'N'
+        self.neutralPieces[index] = (x, y)
+        self.neutralMask ^= self.board.cellBit(oldX, oldY) ^ self.board.cellBit(x, y)
+        return oldX, oldY
+
+    def makeGameMove(self, player, cells, neutralMove=None):
+        # play an l move and optionally a neutral move (pieceIndex, x, y) on the
+        # board itself, only what changed goes on the undo stack
+        oldCells = self.setLPiece(player, cells)
+        oldNeutral = None
+        if neutralMove is not None:
+            index = neutralMove[0]
+            oldNeutral = (index,) + self.setNeutralPiece(*neutralMove)
+        self.undoStack.append((player, oldCells, oldNeutral))
+
+    def unmakeGameMove(self):
+        # take back the last makeGameMove
+        player, oldCells, oldNeutral = self.undoStack.pop()
+        if oldNeutral is not None:
+            self.setNeutralPiece(*oldNeutral)
+        self.setLPiece(player, oldCells)
 
     def moveNeutralPiece(self, chosenNeutralMove):
         # move the neutral piece if human chosen
@@ -343,13 +1076,7 @@ class LGame:
                     print("Error: Target position is not empty.")
                     return
 
-                self.grid[oldX][oldY] = '0'
-                self.grid[newX][newY] = 'N'
-
-                for idx, piece in enumerate(self.neutralPieces):
-                    if piece == (oldX, oldY):
-                        self.neutralPieces[idx] = (newX, newY)
-                        break
+                self.setNeutralPiece(self.neutralPieces.index((oldX, oldY)), newX, newY)
 
         else:
             # if ai is playing, let it pick neutral move
@@ -358,13 +1085,7 @@ class LGame:
 
             aiMove = self.chooseAiNeutralMove()
             if aiMove is not None:
-                pieceIndex, newX, newY = aiMove
-                oldX, oldY = self.neutralPieces[pieceIndex]
-
-                self.grid[oldX][oldY] = '0'
-                self.grid[newX][newY] = 'N'
-
-                self.neutralPieces[pieceIndex] = (newX, newY)
+                self.setNeutralPiece(*aiMove)
 
         self.validateNeutralPieces()
 
@@ -379,131 +1100,2047 @@ class LGame:
 
 
     def chooseAiMoveMinimax(self, legalMoves, player, depth):
-        # choose best move using minimax with alpha beta pruning
+        # choose best move using minimax with alpha beta pruning, what the
+        # search did is left in lastSearchStats
+        if self.profilePath is not None:
+            path = self.profilePath
+            self.profilePath = None
+            profiler = cProfile.Profile()
+            move = profiler.runcall(self.chooseAiMoveMinimax, legalMoves, player, depth)
+            profiler.dump_stats(path)
+            return move
+        # the time limit covers the whole move, so the clock starts and garbage
+        # collection stops before anything is allocated, a collection pause can blow
+        # the limit and the search frees everything it allocates without it
+        start = time.perf_counter()
+        self.deadline = None if self.timeLimit is None else start + self.timeLimit * (1 - TIME_MARGIN)
+        gcWasEnabled = gc.isenabled()
+        if self.deadline is not None:
+            gc.disable()
+        try:
+            stats = SearchStats()
+            self.lastSearchStats = stats
+            cache = self.cache if self.searchMode == 'full' else self.twoStageCache
+            before = (self.nodes, self.cutoffs, cache.probes, cache.hits, cache.collisions)
+            if self.collectStats:
+                self.instrumentSearch(stats)
+            try:
+                move = self.searchAiMove(legalMoves, player, depth, stats)
+            finally:
+                stats.seconds = time.perf_counter() - start
+                if self.collectStats:
+                    self.removeInstrumentation()
+        finally:
+            if gcWasEnabled:
+                gc.enable()
+        stats.nodes = self.nodes - before[0]
+        stats.cutoffs = self.cutoffs - before[1]
+        stats.cacheProbes = cache.probes - before[2]
+        stats.cacheHits = cache.hits - before[3]
+        stats.cacheCollisions = cache.collisions - before[4]
+        return move
+
+    def instrumentSearch(self, stats):
+        # shadow the hot methods on this instance with timed versions, the
+        # class methods stay untouched so searches without stats pay nothing
+        stats.moveGenSeconds = 0.0
+        stats.orderSeconds = 0.0
+        stats.evalSeconds = 0.0
+
+        def timed(method, field):
+            def wrapper(*args):
+                start = time.perf_counter()
+                result = method(*args)
+                setattr(stats, field, getattr(stats, field) + time.perf_counter() - start)
+                return result
+            return wrapper
+
+        def timedIter(method, field):
+            # a generator does its work in next(), so time every step
+            def wrapper(*args):
+                iterator = method(*args)
+                done = object()
+                while True:
+                    start = time.perf_counter()
+                    item = next(iterator, done)
+                    setattr(stats, field, getattr(stats, field) + time.perf_counter() - start)
+                    if item is done:
+                        return
+                    yield item
+            return wrapper
+
+        self.genPlayerFullMoves = timed(self.genPlayerFullMoves, 'moveGenSeconds')
+        self.iterPlacementMasks = timedIter(self.iterPlacementMasks, 'moveGenSeconds')
+        self.iterPlayerFullMoves = timedIter(self.iterPlayerFullMoves, 'moveGenSeconds')
+        self.orderMoves = timed(self.orderMoves, 'orderSeconds')
+        self.historyMoves = timed(self.historyMoves, 'orderSeconds')
+        self.heuristicEvaluation = timed(self.heuristicEvaluation, 'evalSeconds')
+        self.leafScore = timed(self.leafScore, 'evalSeconds')
+
+    def removeInstrumentation(self):
+        # drop the timed versions again
+        for name in ('genPlayerFullMoves', 'iterPlacementMasks', 'iterPlayerFullMoves', 'orderMoves', 'historyMoves', 'heuristicEvaluation', 'leafScore'):
+            self.__dict__.pop(name, None)
+
+    def searchAiMove(self, legalMoves, player, depth, stats):
+        # tablebase first, then the configured search
+        if self.tablebase is not None:
+            move = self.chooseTablebaseMove(legalMoves, player)
+            if move is not None:
+                stats.source = 'tablebase'
+                return move
+        stats.source = self.searchMode
+        if self.searchMode == 'full':
+            return self.chooseFullMove(legalMoves, player, depth)
+        return self.chooseTwoStageMove(legalMoves, player, depth, stats)
+
+    def chooseTwoStageMove(self, legalMoves, player, depth, stats):
+        # l moves only, the neutral move is picked greedily afterwards
+        # with timeLimit set it deepens one ply at a time and keeps the move of the
+        # last finished depth, like chooseFullMove
+        originalMasks = (self.p1Mask, self.p2Mask, self.neutralMask)
+        self.hash = self.board.zobristHash(*originalMasks)
+        self.twoStageCache.newSearch()
+        self.completedDepth = 0
+        bestMove = legalMoves[0] if legalMoves else None
+        for iterationDepth in (range(1, depth + 1) if self.deadline is not None else (depth,)):
+            try:
+                bestMove = self.searchTwoStageRoot(legalMoves, player, iterationDepth)
+            except SearchTimeout:
+                self.p1Mask, self.p2Mask, self.neutralMask = originalMasks
+                self.hash = self.board.zobristHash(*originalMasks)
+                stats.timedOut = True
+                break
+            self.completedDepth = iterationDepth
+            stats.completedDepth = iterationDepth
+        return bestMove
+
+    def searchTwoStageRoot(self, legalMoves, player, depth):
+        # best l move at depth
         opponent = 'L1' if player == 'L2' else 'L2'
+        # l2 maximises the score and l1 minimises it
+        maximizing = player == 'L2'
         bestMove = None
-        bestValue = -math.inf
+        bestValue = -math.inf if maximizing else math.inf
         alpha = -math.inf
         beta = math.inf
-        originalGrid = [row[:] for row in self.grid]
-        originalP1Pos = self.p1Pos[:]
-        originalP2Pos = self.p2Pos[:]
-        originalNeutrals = self.neutralPieces[:]
+        ownMask, _ = self.playerMasks(player)
         for move in legalMoves:
-            self.simulateMove(player, move)
+            self.simulateMask(player, self.board.cellsToMask(move))
             value = self.minimax(opponent, depth - 1, alpha, beta, maximizing=(opponent == 'L2'))
-            self.restoreState(originalGrid, originalP1Pos, originalP2Pos)
-            self.neutralPieces = originalNeutrals[:]
-            if value > bestValue:
+            self.simulateMask(player, ownMask)
+            if maximizing and value > bestValue:
                 bestValue = value
                 bestMove = move
-            alpha = max(alpha, value)
-            if beta <= alpha:
-                break
+                alpha = max(alpha, value)
+            elif not maximizing and value < bestValue:
+                bestValue = value
+                bestMove = move
+                beta = min(beta, value)
         return bestMove
 
+    def clearSearchState(self):
+        # forget what earlier searches learned (cached positions, history), so the
+        # next search gives the same result whatever was searched before it
+        self.cache.clear()
+        self.twoStageCache.clear()
+        self.history = {'L1': {}, 'L2': {}}
+
+    def decayHistory(self):
+        # older history still helps ordering but should not dominate, once the
+        # time is up the rest is left as it is, it only changes the move order
+        for table in self.history.values():
+            for i, move in enumerate(table):
+                if self.deadline is not None and i % TIME_CHECK_NODES == 0 and time.perf_counter() > self.deadline:
+                    return
+                table[move] //= 4
+
+    def chooseFullMove(self, legalMoves, player, depth):
+        # search l move and neutral move together, the neutral part is kept for chooseAiNeutralMove
+        # iterative deepening: depth 1, 2, ... up to depth, or until timeLimit runs out
+        allowed = {self.board.cellsToMask(move): move for move in legalMoves}
+        rootMoves = [move for move in self.genPlayerFullMoves(player) if move[0] in allowed]
+        if not rootMoves:
+            return None
+        originalMasks = (self.p1Mask, self.p2Mask, self.neutralMask)
+        self.hash = self.board.zobristHash(*originalMasks)
+        self.cache.newSearch()
+        self.killers = [[None, None] for _ in range(max(depth, 1) + 1)]
+        self.decayHistory()
+        self.pv = []
+        self.completedDepth = 0
+        self.bestFullValue = None
+        bestMove = rootMoves[0]
+        for iterationDepth in range(1, max(depth, 1) + 1):
+            self.rootDepth = iterationDepth
+            iterationStart = time.perf_counter()
+            iterationNodes = self.nodes
+            self.rootScores = {}
+            try:
+                if self.workers > 1 and iterationDepth >= PARALLEL_MIN_DEPTH:
+                    value, scores = self.searchRootParallel(rootMoves, player, iterationDepth)
+                else:
+                    value, scores = self.searchRoot(rootMoves, player, iterationDepth)
+            except SearchTimeout:
+                # the search was cut off somewhere deep, put the masks back
+                self.p1Mask, self.p2Mask, self.neutralMask = originalMasks
+                self.hash = self.board.zobristHash(*originalMasks)
+                self.lastSearchStats.timedOut = True
+                # the unfinished iteration searched the previous best move first, a
+                # move that scored better after it is better at this depth, and on
+                # big boards it is all there is when depth 1 did not finish
+                partial = self.rootScores
+                if rootMoves[0] in partial:
+                    bestMove = (max if player == 'L2' else min)(partial, key=partial.get)
+                break
+            self.lastSearchStats.depths.append((iterationDepth, time.perf_counter() - iterationStart, self.nodes - iterationNodes))
+            # best move first for the next iteration, then the rest by score
+            rootMoves.sort(key=lambda move: scores[move], reverse=(player == 'L2'))
+            bestMove = rootMoves[0]
+            self.bestFullValue = value
+            self.completedDepth = iterationDepth
+            self.lastSearchStats.completedDepth = iterationDepth
+            self.pv = self.principalVariation(player, bestMove, iterationDepth)
+            if abs(value) >= WIN_SCORE:
+                # a forced result does not change with more depth
+                break
+        self.hasNeutralPlan = True
+        self.neutralPlan = self.neutralMoveFromMasks(originalMasks[2], bestMove[1])
+        self.bestFullMove = bestMove
+        return allowed[bestMove[0]]
+
+    def searchRoot(self, rootMoves, player, depth):
+        # one iteration over the root moves, returns the value and the score of each move
+        opponent = 'L1' if player == 'L2' else 'L2'
+        maximizing = player == 'L2'
+        bestValue = -math.inf if maximizing else math.inf
+        alpha = -math.inf
+        beta = math.inf
+        scores = self.rootScores
+        for move in rootMoves:
+            if depth == 1:
+                # nothing is searched below the root, score the children from the masks
+                value = self.leafScore(player, move)
+            else:
+                undo = self.makeFullMove(player, move)
+                value = self.fullMinimax(opponent, depth - 1, alpha, beta)
+                self.unmakeFullMove(player, undo)
+            scores[move] = value
+            if maximizing and value > bestValue:
+                bestValue = value
+                alpha = max(alpha, value)
+            elif not maximizing and value < bestValue:
+                bestValue = value
+                beta = min(beta, value)
+        return bestValue, scores
+
+    def searchRootParallel(self, rootMoves, player, depth):
+        # searchRoot over the worker pool: the first (best so far) move is searched
+        # here for a bound, the rest go out in chunks searched against that bound
+        opponent = 'L1' if player == 'L2' else 'L2'
+        maximizing = player == 'L2'
+        undo = self.makeFullMove(player, rootMoves[0])
+        bestValue = self.fullMinimax(opponent, depth - 1, -math.inf, math.inf)
+        self.unmakeFullMove(player, undo)
+        scores = self.rootScores = {rootMoves[0]: bestValue}
+        # workers get the position and the moves as masks, Position only packs 4x4 boards
+        position = (self.board.size, self.p1Mask, self.p2Mask, self.neutralMask, player)
+        remaining = None if self.deadline is None else self.deadline - time.perf_counter()
+        rest = rootMoves[1:]
+        chunkSize = max(1, -(-len(rest) // (self.workers * PARALLEL_CHUNKS)))
+        chunks = [rest[i:i + chunkSize] for i in range(0, len(rest), chunkSize)]
+        pool = self.rootPool()
+        # the cache age tells the workers when a new root search starts
+        futures = [pool.submit(searchRootChunk, position, chunk, depth, bestValue, remaining, self.cache.age) for chunk in chunks]
+        try:
+            for chunk, future in zip(chunks, futures):
+                values, (nodes, cutoffs, probes, hits, collisions) = future.result()
+                # the workers' tables count as this search's cache
+                self.nodes += nodes
+                self.cutoffs += cutoffs
+                self.cache.probes += probes
+                self.cache.hits += hits
+                self.cache.collisions += collisions
+                if values is None:
+                    raise SearchTimeout()
+                scores.update(zip(chunk, values))
+        finally:
+            for future in futures:
+                future.cancel()
+        # values that did not beat the bound are only bounds, but never the best
+        best = max(scores.values()) if maximizing else min(scores.values())
+        return best, scores
+
+    def rootPool(self):
+        # the worker pool, started once and reused for every move
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(self.workers, initializer=initRootWorker, initargs=(self.cache.size,))
+        return self.pool
+
+    def close(self):
+        # stop the worker pool, if any
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+
+    def scoreFullMove(self, player, move, depth):
+        # full window value of one move searched to depth, cheap right after a
+        # search of the same position has filled the cache
+        opponent = 'L1' if player == 'L2' else 'L2'
+        self.hash = self.board.zobristHash(self.p1Mask, self.p2Mask, self.neutralMask)
+        self.deadline = None
+        self.rootDepth = depth
+        undo = self.makeFullMove(player, move)
+        value = self.fullMinimax(opponent, depth - 1, -math.inf, math.inf)
+        self.unmakeFullMove(player, undo)
+        return value
+
+    def principalVariation(self, player, firstMove, depth):
+        # expected line of play: the root move followed by the best moves stored in the cache
+        line = [firstMove]
+        undos = [(player, self.makeFullMove(player, firstMove))]
+        player = 'L1' if player == 'L2' else 'L2'
+        while len(line) < depth:
+            positionHash, t = self.board.canonicalHash(self.hash, self.p1Mask, self.p2Mask, self.neutralMask)
+            entry = self.cache.probe(positionHash ^ self.board.zobristSide[player])
+            if entry is None or entry[3] is None:
+                break
+            move = self.board.transformFullMove(self.board.inverseSymmetries[t], entry[3])
+            ownMask, blocked = self.playerMasks(player)
+            if move not in self.board.genFullMoves(ownMask, blocked & ~self.neutralMask, self.neutralMask):
+                break
+            line.append(move)
+            undos.append((player, self.makeFullMove(player, move)))
+            player = 'L1' if player == 'L2' else 'L2'
+        for undoPlayer, undo in reversed(undos):
+            self.unmakeFullMove(undoPlayer, undo)
+        return line
+
+    def iterFullMoves(self, player, ply, ttMove):
+        # cache move, principal variation move and killers first, the rest by history
+        # these often cut off, so the full list is only built and sorted when they do not
+        ownMask, blocked = self.playerMasks(player)
+        neutralMask = self.neutralMask
+        oppMask = blocked & ~neutralMask
+        first = [ttMove]
+        if ply < len(self.pv):
+            first.append(self.pv[ply])
+        if ply < len(self.killers):
+            first.extend(self.killers[ply])
+        tried = []
+        for move in first:
+            if move is not None and move not in tried and self.board.isFullMoveLegal(ownMask, oppMask, neutralMask, move):
+                tried.append(move)
+                yield move
+        # the caller has undone its moves by now, the masks are back as they were
+        # every l placement comes with no neutral move or one of 2 * free cells relocations
+        count = self.board.countLegalPlacements(ownMask, blocked) * (1 + 2 * (self.board.cellCount - 10))
+        if len(self.history[player]) >= count:
+            moves = self.orderMoves(self.genPlayerFullMoves(player), player)
+            for move in moves:
+                if move not in tried:
+                    yield move
+            return
+        # thousands of moves on bigger boards but few of them with history: rank just
+        # those and generate the rest lazily, in the order the full sort leaves them
+        ranked = self.historyMoves(player, tried)
+        skip = set(tried)
+        skip.update(ranked)
+        yield from ranked
+        for move in self.iterPlayerFullMoves(player):
+            if move not in skip:
+                yield move
+
+    def historyMoves(self, player, tried):
+        # legal moves with a history score, best first, ties in generation order
+        ownMask, blocked = self.playerMasks(player)
+        neutralMask = self.neutralMask
+        oppMask = blocked & ~neutralMask
+        history = self.history[player]
+        lIndex = self.board.lIndex
+        lowNeutral = neutralMask & -neutralMask
+
+        def order(move):
+            lMask, newNeutrals = move
+            if newNeutrals == neutralMask:
+                return -history[move], lIndex[lMask], 0, 0
+            piece = 1 if neutralMask & ~newNeutrals == lowNeutral else 2
+            return -history[move], lIndex[lMask], piece, newNeutrals & ~neutralMask
+
+        return sorted((move for move in history
+                       if move not in tried and self.board.isFullMoveLegal(ownMask, oppMask, neutralMask, move)), key=order)
+
+    def orderMoves(self, moves, player):
+        # moves that cut off often before
+        history = self.history[player]
+        if history:
+            moves.sort(key=lambda move: history.get(move, 0), reverse=True)
+        return moves
+
+    def recordCutoff(self, player, move, ply, depth):
+        # a move that caused a cutoff is tried early in sibling positions
+        self.cutoffs += 1
+        killers = self.killers[ply] if ply < len(self.killers) else None
+        if killers is not None and killers[0] != move:
+            killers[1] = killers[0]
+            killers[0] = move
+        history = self.history[player]
+        history[move] = history.get(move, 0) + depth * depth
+
+    def fullMinimax(self, player, depth, alpha, beta):
+        # minimax where every ply is an l move plus an optional neutral move
+        self.nodes += 1
+        if self.deadline is not None and self.nodes % TIME_CHECK_NODES == 0 and time.perf_counter() > self.deadline:
+            raise SearchTimeout()
+        maximizing = player == 'L2'
+        if depth == 0:
+            return self.evaluateLeaf(player, depth)
+        # mirrored positions share one entry, moves are stored in the canonical frame
+        board = self.board
+        positionHash, t = board.canonicalHash(self.hash, self.p1Mask, self.p2Mask, self.neutralMask)
+        key = positionHash ^ board.zobristSide[player]
+        entry = self.cache.probe(key)
+        ttMove = None
+        if entry is not None:
+            entryDepth, entryValue, flag, ttMove = entry
+            if ttMove is not None:
+                ttMove = board.transformFullMove(board.inverseSymmetries[t], ttMove)
+            if entryDepth >= depth:
+                value = scoreFromTable(entryValue, depth)
+                if flag == BOUND_EXACT:
+                    return value
+                if flag == BOUND_LOWER and value >= beta:
+                    return value
+                if flag == BOUND_UPPER and value <= alpha:
+                    return value
+        if not self.hasLegalMove(player):
+            return self.evaluateLeaf(player, depth)
+        ply = self.rootDepth - depth
+        moves = self.iterFullMoves(player, ply, ttMove)
+        opponent = 'L1' if player == 'L2' else 'L2'
+        originalAlpha = alpha
+        originalBeta = beta
+        bestMove = None
+        if maximizing:
+            value = -math.inf
+            for move in moves:
+                if depth == 1:
+                    score = self.leafScore(player, move)
+                else:
+                    undo = self.makeFullMove(player, move)
+                    score = self.fullMinimax(opponent, depth - 1, alpha, beta)
+                    self.unmakeFullMove(player, undo)
+                if score > value:
+                    value = score
+                    bestMove = move
+                alpha = max(alpha, value)
+                if beta <= alpha:
+                    self.recordCutoff(player, move, ply, depth)
+                    break
+        else:
+            value = math.inf
+            for move in moves:
+                if depth == 1:
+                    score = self.leafScore(player, move)
+                else:
+                    undo = self.makeFullMove(player, move)
+                    score = self.fullMinimax(opponent, depth - 1, alpha, beta)
+                    self.unmakeFullMove(player, undo)
+                if score < value:
+                    value = score
+                    bestMove = move
+                beta = min(beta, value)
+                if beta <= alpha:
+                    self.recordCutoff(player, move, ply, depth)
+                    break
+        if bestMove is not None:
+            bestMove = board.transformFullMove(t, bestMove)
+        self.cache.store(key, depth, scoreToTable(value, depth), boundFlag(value, originalAlpha, originalBeta), bestMove)
+        return value
+
+    def evaluateLeaf(self, player, depth):
+        # a player without an l move has lost, otherwise use the heuristic
+        ownMask, blocked = self.playerMasks(player)
+        if not self.board.countLegalPlacements(ownMask, blocked):
+            return -(WIN_SCORE + depth) if player == 'L2' else WIN_SCORE + depth
+        return self.heuristicEvaluation()
+
+    def leafScore(self, player, move):
+        # what fullMinimax returns for the position after move with no depth left,
+        # worked out from the masks without making the move, leaves are most of the
+        # nodes and on bigger boards a node can have thousands of them
+        self.nodes += 1
+        if self.deadline is not None and self.nodes % TIME_CHECK_NODES == 0 and time.perf_counter() > self.deadline:
+            raise SearchTimeout()
+        # the opponent's mobility counts its own spot, so 1 means it cannot move
+        lMask, newNeutrals = move
+        mobility = self.board.mobility
+        if player == 'L1':
+            p2Moves = mobility[lMask | newNeutrals]
+            if p2Moves == 1:
+                return -WIN_SCORE
+            return p2Moves - mobility[self.p2Mask | newNeutrals]
+        p1Moves = mobility[lMask | newNeutrals]
+        if p1Moves == 1:
+            return WIN_SCORE
+        return mobility[self.p1Mask | newNeutrals] - p1Moves
+
+    def makeFullMove(self, player, move):
+        # apply (l mask, neutral mask) to the masks and hash, returns what undoes it
+        lMask, newNeutrals = move
+        board = self.board
+        if player == 'L1':
+            undo = (self.p1Mask, self.neutralMask, self.hash)
+            self.hash ^= board.zobristL1[self.p1Mask] ^ board.zobristL1[lMask]
+            self.p1Mask = lMask
+        else:
+            undo = (self.p2Mask, self.neutralMask, self.hash)
+            self.hash ^= board.zobristL2[self.p2Mask] ^ board.zobristL2[lMask]
+            self.p2Mask = lMask
+        if newNeutrals != self.neutralMask:
+            self.hash ^= board.zobristNeutral[self.neutralMask & ~newNeutrals] ^ board.zobristNeutral[newNeutrals & ~self.neutralMask]
+            self.neutralMask = newNeutrals
+        return undo
+
+    def unmakeFullMove(self, player, undo):
+        # put the masks and hash back the way makeFullMove found them
+        if player == 'L1':
+            self.p1Mask, self.neutralMask, self.hash = undo
+        else:
+            self.p2Mask, self.neutralMask, self.hash = undo
+
+    def chooseTablebaseMove(self, legalMoves, player):
+        # pick the best l move and neutral move straight from the tablebase
+        ownMask, blocked = self.playerMasks(player)
+        oppMask = blocked & ~self.neutralMask
+        if self.tablebase.probe(ownMask, oppMask, self.neutralMask) is None:
+            return None
+        allowed = {self.board.cellsToMask(move): move for move in legalMoves}
+        bestKey = None
+        bestMove = None
+        for lMask, newNeutrals in self.board.genFullMoves(ownMask, oppMask, self.neutralMask):
+            if lMask not in allowed:
+                continue
+            res, dist = self.tablebase.probe(oppMask, lMask, newNeutrals)
+            # opponent lost: win fast, draw: keep opponent short of moves, opponent won: lose slowly
+            if res == RESULT_LOSS:
+                key = (2, -dist)
+            elif res == RESULT_DRAW:
+                key = (1, -self.board.countLegalPlacements(oppMask, lMask | newNeutrals))
+            else:
+                key = (0, dist)
+            if bestKey is None or key > bestKey:
+                bestKey = key
+                bestMove = (lMask, newNeutrals)
+        if bestMove is None:
+            return None
+        lMask, newNeutrals = bestMove
+        self.hasNeutralPlan = True
+        self.neutralPlan = self.neutralMoveFromMasks(self.neutralMask, newNeutrals)
+        return allowed[lMask]
+
+    def neutralMoveFromMasks(self, oldNeutrals, newNeutrals):
+        # turn a change of the neutral mask into (pieceIndex, x, y)
+        if oldNeutrals == newNeutrals:
+            return None
+        fromBit = oldNeutrals & ~newNeutrals
+        toBit = newNeutrals & ~oldNeutrals
+        x, y = divmod(toBit.bit_length() - 1, self.board.size)
+        for i, (nx, ny) in enumerate(self.neutralPieces):
+            if self.board.cellBit(nx, ny) == fromBit:
+                return (i, x, y)
+        return None
+
     def minimax(self, player, depth, alpha, beta, maximizing):
-        # minimax algorithm with caching
-        key = (tuple(tuple(row) for row in self.grid), tuple(self.p1Pos), tuple(self.p2Pos), tuple(sorted(self.neutralPieces)), player, depth, maximizing)
-        if key in self.cache:
-            return self.cache[key]
+        # minimax algorithm with caching, the search only touches the masks
+        self.nodes += 1
+        if self.deadline is not None and self.nodes % TIME_CHECK_NODES == 0 and time.perf_counter() > self.deadline:
+            raise SearchTimeout()
         if depth == 0:
-            v = self.heuristicEvaluation()
-            self.cache[key] = v
-            return v
-        legalMoves = self.genLegalMoves(player)
-        if not legalMoves:
-            v = self.heuristicEvaluation()
-            self.cache[key] = v
-            return v
+            return self.heuristicEvaluation()
+        board = self.board
+        positionHash, t = board.canonicalHash(self.hash, self.p1Mask, self.p2Mask, self.neutralMask)
+        key = positionHash ^ board.zobristSide[player]
+        entry = self.twoStageCache.probe(key)
+        ttMove = None
+        if entry is not None:
+            entryDepth, value, flag, ttMove = entry
+            if ttMove is not None:
+                ttMove = board.transformMask(board.inverseSymmetries[t], ttMove)
+            if entryDepth >= depth:
+                if flag == BOUND_EXACT:
+                    return value
+                if flag == BOUND_LOWER and value >= beta:
+                    return value
+                if flag == BOUND_UPPER and value <= alpha:
+                    return value
+        ownMask = self.p1Mask if player == 'L1' else self.p2Mask
+        if not self.hasLegalMove(player):
+            return self.heuristicEvaluation()
+        legalMoves = self.iterPlacementMasks(player, ttMove)
         opponent = 'L1' if player == 'L2' else 'L2'
-        originalGrid = [row[:] for row in self.grid]
-        originalP1Pos = self.p1Pos[:]
-        originalP2Pos = self.p2Pos[:]
-        originalNeutrals = self.neutralPieces[:]
+        originalAlpha = alpha
+        originalBeta = beta
+        bestMove = None
         if maximizing:
             value = -math.inf
             for move in legalMoves:
-                self.simulateMove(player, move)
+                self.simulateMask(player, move)
                 score = self.minimax(opponent, depth - 1, alpha, beta, maximizing=(opponent=='L2'))
-                self.restoreState(originalGrid, originalP1Pos, originalP2Pos)
-                self.neutralPieces = originalNeutrals[:]
-                value = max(value, score)
+                if score > value:
+                    value = score
+                    bestMove = move
                 alpha = max(alpha, value)
                 if beta <= alpha:
+                    self.cutoffs += 1
                     break
-            self.cache[key] = value
-            return value
         else:
             value = math.inf
             for move in legalMoves:
-                self.simulateMove(player, move)
+                self.simulateMask(player, move)
                 score = self.minimax(opponent, depth - 1, alpha, beta, maximizing=(opponent=='L2'))
-                self.restoreState(originalGrid, originalP1Pos, originalP2Pos)
-                self.neutralPieces = originalNeutrals[:]
-                value = min(value, score)
+                if score < value:
+                    value = score
+                    bestMove = move
                 beta = min(beta, value)
                 if beta <= alpha:
+                    self.cutoffs += 1
                     break
-            self.cache[key] = value
-            return value
-
-    def simulateMove(self, player, move):
-        # simulate placing the piece in new position
-        oldPositions = self.p1Pos if player == 'L1' else self.p2Pos
-        self.removePiece(oldPositions)
-        self.placePiece(move, player)
+        self.simulateMask(player, ownMask)
+        if bestMove is not None:
+            bestMove = board.transformMask(t, bestMove)
+        self.twoStageCache.store(key, depth, value, boundFlag(value, originalAlpha, originalBeta), bestMove)
+        return value
+
+    def simulateMask(self, player, mask):
+        # move a piece during search without touching the grid
+        board = self.board
         if player == 'L1':
-            self.p1Pos = move
+            self.hash ^= board.zobristL1[self.p1Mask] ^ board.zobristL1[mask]
+            self.p1Mask = mask
         else:
-            self.p2Pos = move
+            self.hash ^= board.zobristL2[self.p2Mask] ^ board.zobristL2[mask]
+            self.p2Mask = mask
+
+    def perft(self, player, depth):
+        # count l move sequences of length depth through genLegalMoves and makeGameMove
+        if depth == 0:
+            return 1
+        legalMoves = self.genLegalMoves(player)
+        if depth == 1:
+            return len(legalMoves)
+        opponent = 'L1' if player == 'L2' else 'L2'
+        total = 0
+        for move in legalMoves:
+            self.makeGameMove(player, move)
+            total += self.perft(opponent, depth - 1)
+            self.unmakeGameMove()
+        return total
+
+    def fullPerft(self, player, depth):
+        # same for full moves (l move plus optional neutral move) on the masks
+        ownMask, blocked = self.playerMasks(player)
+        moves = self.board.genFullMoves(ownMask, blocked & ~self.neutralMask, self.neutralMask)
+        if depth <= 1:
+            return len(moves) if depth == 1 else 1
+        opponent = 'L1' if player == 'L2' else 'L2'
+        total = 0
+        for move in moves:
+            undo = self.makeFullMove(player, move)
+            total += self.fullPerft(opponent, depth - 1)
+            self.unmakeFullMove(player, undo)
+        return total
 
     def heuristicEvaluation(self):
         # basic heuristic: difference in number of moves
-        l1Moves = len(self.genLegalMoves('L1'))
-        l2Moves = len(self.genLegalMoves('L2'))
-        return l2Moves - l1Moves
+        # both counts include the piece's own spot, which cancels out
+        mobility = self.board.mobility
+        return mobility[self.p1Mask | self.neutralMask] - mobility[self.p2Mask | self.neutralMask]
 
     def chooseAiNeutralMove(self):
         # ai tries moving neutral pieces to reduce opponent moves
+        if self.hasNeutralPlan:
+            self.hasNeutralPlan = False
+            return self.neutralPlan
         player = self.currentPlayer
         opponent = 'L1' if player == 'L2' else 'L2'
         bestMove = None
         bestScore = self.evaluateOpponentMoves(opponent)
-        originalNeutrals = self.neutralPieces[:]
-        originalGrid = [row[:] for row in self.grid]
-        originalP1Pos = self.p1Pos[:]
-        originalP2Pos = self.p2Pos[:]
+        originalNeutralMask = self.neutralMask
+        occupied = self.p1Mask | self.p2Mask | self.neutralMask
         for i, (nx, ny) in enumerate(self.neutralPieces):
-            self.grid[nx][ny] = '0'
-            for x in range(4):
-                for y in range(4):
-                    if self.grid[x][y] == '0':
-                        self.grid[x][y] = 'N'
-                        self.neutralPieces[i] = (x, y)
+            otherNeutrals = originalNeutralMask & ~self.board.cellBit(nx, ny)
+            for x in range(self.board.size):
+                for y in range(self.board.size):
+                    if not occupied & self.board.cellBit(x, y):
+                        self.neutralMask = otherNeutrals | self.board.cellBit(x, y)
                         newScore = self.evaluateOpponentMoves(opponent)
                         if newScore < bestScore:
                             bestScore = newScore
                             bestMove = (i, x, y)
-                        self.grid[x][y] = '0'
-                        self.neutralPieces[i] = (nx, ny)
-            self.grid[nx][ny] = 'N'
-        self.restoreState(originalGrid, originalP1Pos, originalP2Pos)
-        self.neutralPieces = originalNeutrals
+        self.neutralMask = originalNeutralMask
         return bestMove
 
     def evaluateOpponentMoves(self, opponent):
         # check how many moves opponent can do
-        return len(self.genLegalMoves(opponent))
+        ownMask, blocked = self.playerMasks(opponent)
+        return self.board.countLegalPlacements(ownMask, blocked)
+
+
+# tablebase: every position solved by retrograde analysis
+# positions are seen from the side to move: (own l, opponent l, neutral pair)
+# and only the canonical one of each set of mirrored positions is stored
+TABLEBASE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lgame.tb')
+TABLEBASE_MAGIC = b'LGTB'
+TABLEBASE_VERSION = 2
+TABLEBASE_HEADER = 8
+TABLEBASE_SIZE = len(CANONICAL_L) * len(L_MASKS) * len(NEUTRAL_PAIRS)
+# each entry is one byte: result in the top two bits, plies to the end in the rest
+RESULT_DRAW = 1
+RESULT_WIN = 2
+RESULT_LOSS = 3
+MAX_DISTANCE = 63
+
+
+# packed position -> table index, filled as positions are looked up
+TABLEBASE_INDEXES = {}
+
+
+def tablebaseIndex(ownMask, oppMask, neutralMask):
+    # where a position lives in the table, mirrored positions share a slot
+    packed = ownMask | oppMask << 16 | neutralMask << 32
+    index = TABLEBASE_INDEXES.get(packed)
+    if index is None:
+        (ownMask, oppMask, neutralMask), _ = canonicalPosition(ownMask, oppMask, neutralMask)
+        index = (CANONICAL_L_INDEX[ownMask] * len(L_MASKS) + L_INDEX[oppMask]) * len(NEUTRAL_PAIRS) + NEUTRAL_INDEX[neutralMask]
+        TABLEBASE_INDEXES[packed] = index
+    return index
+
+
+def genAllPositions():
+    # every legal position with the side to move first
+    positions = []
+    for ownMask in L_MASKS:
+        for oppMask in L_MASKS:
+            if ownMask & oppMask:
+                continue
+            for neutralMask in NEUTRAL_PAIRS:
+                if not neutralMask & (ownMask | oppMask):
+                    positions.append((ownMask, oppMask, neutralMask))
+    return positions
+
+
+def genCanonicalPositions():
+    # one position out of every set of mirrored positions
+    return [pos for pos in genAllPositions() if canonicalPosition(*pos)[0] == pos]
+
+
+def solveTablebase():
+    # label every position win/loss/draw with distance to the end
+    positions = genCanonicalPositions()
+    dense = {tablebaseIndex(*pos): i for i, pos in enumerate(positions)}
+    predecessors = [[] for _ in positions]
+    remaining = [0] * len(positions)
+    result = [0] * len(positions)
+    distance = [0] * len(positions)
+    queue = deque()
+    for i, (ownMask, oppMask, neutralMask) in enumerate(positions):
+        children = {dense[tablebaseIndex(oppMask, lMask, newNeutrals)]
+                    for lMask, newNeutrals in genFullMoves(ownMask, oppMask, neutralMask)}
+        for child in children:
+            predecessors[child].append(i)
+        remaining[i] = len(children)
+        if not children:
+            # side to move cannot move its l piece and has lost
+            result[i] = RESULT_LOSS
+            queue.append(i)
+    # positions come off the queue in order of distance, so the first
+    # loss reached is the fastest win and the last win reached is the slowest loss
+    while queue:
+        child = queue.popleft()
+        for parent in predecessors[child]:
+            if result[parent]:
+                continue
+            if result[child] == RESULT_LOSS:
+                result[parent] = RESULT_WIN
+                distance[parent] = distance[child] + 1
+                queue.append(parent)
+            else:
+                remaining[parent] -= 1
+                if remaining[parent] == 0:
+                    result[parent] = RESULT_LOSS
+                    distance[parent] = distance[child] + 1
+                    queue.append(parent)
+    table = bytearray(TABLEBASE_SIZE)
+    for i, pos in enumerate(positions):
+        if distance[i] > MAX_DISTANCE:
+            raise ValueError("distance does not fit in the table")
+        table[tablebaseIndex(*pos)] = ((result[i] or RESULT_DRAW) << 6) | distance[i]
+    return table
+
+
+def writeTablebase(table, path=TABLEBASE_PATH):
+    # save the table with a small header
+    with open(path, 'wb') as f:
+        f.write(TABLEBASE_MAGIC + bytes([TABLEBASE_VERSION, BOARD_SIZE, 0, 0]))
+        f.write(table)
+
+
+class Tablebase:
+    def __init__(self, path=TABLEBASE_PATH):
+        # memory map the solved table, nothing is read until probed
+        with open(path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header = self.data[:TABLEBASE_HEADER]
+        if header[:4] != TABLEBASE_MAGIC or header[4] != TABLEBASE_VERSION or header[5] != BOARD_SIZE:
+            raise ValueError(f"{path} is not a tablebase for this version")
+        if len(self.data) != TABLEBASE_HEADER + TABLEBASE_SIZE:
+            raise ValueError(f"{path} has the wrong size")
+
+    def probe(self, ownMask, oppMask, neutralMask):
+        # result and distance for the side to move, None if not a legal position
+        if ownMask not in L_INDEX or oppMask not in L_INDEX or neutralMask not in NEUTRAL_INDEX:
+            return None
+        entry = self.data[TABLEBASE_HEADER + tablebaseIndex(ownMask, oppMask, neutralMask)]
+        if not entry:
+            return None
+        return entry >> 6, entry & MAX_DISTANCE
+
+    def table(self):
+        # raw table without the header
+        return self.data[TABLEBASE_HEADER:]
+
+
+LOADED_TABLEBASES = {}
+
+
+def loadTablebase(path=TABLEBASE_PATH):
+    # open the tablebase if it has been generated, every game shares one mapping
+    # a stale or broken file is skipped with a warning, the engine then just searches
+    if path not in LOADED_TABLEBASES:
+        table = None
+        if os.path.exists(path):
+            try:
+                table = Tablebase(path)
+            except (ValueError, OSError) as error:
+                print(f"ignoring tablebase: {error}, run 'python3 L-game.py solve' to rebuild it", file=sys.stderr)
+        LOADED_TABLEBASES[path] = table
+    return LOADED_TABLEBASES[path]
+
+
+def verifyTablebase(table):
+    # check every entry against its successors, returns a list of problems
+    problems = []
+    for ownMask, oppMask, neutralMask in genAllPositions():
+        entry = table[tablebaseIndex(ownMask, oppMask, neutralMask)]
+        res, dist = entry >> 6, entry & MAX_DISTANCE
+        children = [table[tablebaseIndex(oppMask, lMask, newNeutrals)]
+                    for lMask, newNeutrals in genFullMoves(ownMask, oppMask, neutralMask)]
+        lossDists = [c & MAX_DISTANCE for c in children if c >> 6 == RESULT_LOSS]
+        winDists = [c & MAX_DISTANCE for c in children if c >> 6 == RESULT_WIN]
+        if res == RESULT_WIN:
+            ok = bool(lossDists) and min(lossDists) + 1 == dist
+        elif res == RESULT_LOSS:
+            ok = len(winDists) == len(children) and (dist == 0 if not children else max(winDists) + 1 == dist)
+        else:
+            ok = res == RESULT_DRAW and not lossDists and len(winDists) < len(children)
+        if not ok:
+            problems.append((ownMask, oppMask, neutralMask))
+    return problems
+
+
+# parallel root search: each worker process keeps one game, and with it its
+# transposition table, for as long as the pool lives
+PARALLEL_MIN_DEPTH = 3
+PARALLEL_CHUNKS = 4
+ROOT_WORKER = {}
+
+
+def initRootWorker(cacheSize):
+    # remember the cache size, a root search worker sets up one game per board size
+    ROOT_WORKER['cacheSize'] = cacheSize
+
+
+def rootWorkerGame(size):
+    # the game a root search worker reuses for a board size
+    if size not in ROOT_WORKER:
+        game = LGame(ROOT_WORKER['cacheSize'], size=size)
+        game.tablebase = None
+        ROOT_WORKER[size] = game
+    return ROOT_WORKER[size]
+
+
+def searchRootChunk(position, moves, depth, bound, remaining, search):
+    # search root moves of the position (size, p1 mask, p2 mask, neutral mask, player)
+    # against the bound found by the first root move, returns (values, (nodes,
+    # cutoffs, cache probes, cache hits, cache collisions)), values is None on a timeout
+    size, p1Mask, p2Mask, neutralMask, player = position
+    game = rootWorkerGame(size)
+    # chunks of one root search share what the worker learned, a new root search
+    # starts from an empty table so earlier moves do not change its values
+    if ROOT_WORKER.get('search') != search:
+        ROOT_WORKER['search'] = search
+        game.clearSearchState()
+    opponent = 'L1' if player == 'L2' else 'L2'
+    maximizing = player == 'L2'
+    game.p1Mask, game.p2Mask, game.neutralMask = p1Mask, p2Mask, neutralMask
+    game.hash = game.board.zobristHash(p1Mask, p2Mask, neutralMask)
+    game.cache.newSearch()
+    game.deadline = None if remaining is None else time.perf_counter() + remaining
+    game.rootDepth = depth
+    game.killers = [[None, None] for _ in range(depth + 1)]
+    game.pv = []
+    cache = game.cache
+    before = (game.nodes, game.cutoffs, cache.probes, cache.hits, cache.collisions)
+    values = []
+    try:
+        for move in moves:
+            undo = game.makeFullMove(player, move)
+            if maximizing:
+                value = game.fullMinimax(opponent, depth - 1, bound, math.inf)
+                bound = max(bound, value)
+            else:
+                value = game.fullMinimax(opponent, depth - 1, -math.inf, bound)
+                bound = min(bound, value)
+            game.unmakeFullMove(player, undo)
+            values.append(value)
+    except SearchTimeout:
+        values = None
+    counts = (game.nodes, game.cutoffs, cache.probes, cache.hits, cache.collisions)
+    return values, tuple(after - start for after, start in zip(counts, before))
+
+
+def checkBatchEvaluation(game):
+    # evaluateBatch on every position against heuristicEvaluation and
+    # chooseAiNeutralMove on a real board, returns (problems, reference seconds, batch seconds)
+    positions = [Position.unrank(rank).packed for rank in range(POSITION_COUNT)]
+    start = time.perf_counter()
+    plain = []
+    greedy = []
+    for packed in positions:
+        game.setPosition(Position(packed))
+        game.hasNeutralPlan = False
+        plain.append(game.heuristicEvaluation())
+        neutralMove = game.chooseAiNeutralMove()
+        if neutralMove is not None:
+            game.setNeutralPiece(*neutralMove)
+        greedy.append(game.heuristicEvaluation())
+    referenceSeconds = time.perf_counter() - start
+    start = time.perf_counter()
+    batchPlain = evaluateBatch(positions)
+    batchGreedy = evaluateBatch(positions, neutralAware=True)
+    batchSeconds = time.perf_counter() - start
+    problems = [f"{Position(packed)}: heuristic {plain[i]} batch {int(batchPlain[i])}"
+                for i, packed in enumerate(positions) if plain[i] != batchPlain[i]]
+    problems += [f"{Position(packed)}: after neutral move {greedy[i]} batch {int(batchGreedy[i])}"
+                 for i, packed in enumerate(positions) if greedy[i] != batchGreedy[i]]
+    return problems, referenceSeconds, batchSeconds
+
+
+def playEngineGame(game, engines, maxPlies, moves=None):
+    # play ai vs ai without drawing the board, engines maps player to (searchMode, depth, timeLimit)
+    # returns the winner (None for a draw) and the number of plies played,
+    # every ply is added to moves as (l mask, neutral from cell, neutral to cell) if given
+    # a position seen for the third time is scored as a draw
+    game.p1Type = 'ai'
+    game.p2Type = 'ai'
+    # repetition counts indexed by Position.rank()
+    seen = bytearray(POSITION_COUNT)
+    for ply in range(maxPlies):
+        if not game.hasLegalMove(game.currentPlayer):
+            return ('L2' if game.currentPlayer == 'L1' else 'L1'), ply
+        rank = game.toPosition().rank()
+        seen[rank] += 1
+        if seen[rank] >= 3:
+            return None, ply
+        game.searchMode, game.aiDepth, game.timeLimit = engines[game.currentPlayer]
+        oldNeutrals = game.neutralMask
+        legalMoves = game.genLegalMoves(game.currentPlayer)
+        move = game.chooseAiMoveMinimax(legalMoves, game.currentPlayer, game.aiDepth)
+        game.makeMove(move)
+        game.moveNeutralPiece(None)
+        if moves is not None:
+            moves.append((cellsToMask(move),) + neutralCells(oldNeutrals, game.neutralMask))
+        game.currentPlayer = 'L2' if game.currentPlayer == 'L1' else 'L1'
+    return None, maxPlies
+
+
+def neutralCells(oldNeutrals, newNeutrals):
+    # (from cell, to cell) numbers of a neutral move, (None, None) if nothing moved
+    if oldNeutrals == newNeutrals:
+        return None, None
+    return (oldNeutrals & ~newNeutrals).bit_length() - 1, (newNeutrals & ~oldNeutrals).bit_length() - 1
+
+
+# game records are one line per game:
+#   p1 p2 neutralA neutralB first winner move move ...
+# p1 and p2 index L_PLACEMENTS, neutrals are cell numbers (x * 4 + y), winner is L1, L2 or D
+# and a move is the new l placement index, followed by :from-to when a neutral piece moved
+def encodeGameRecord(start, firstPlayer, winner, moves):
+    # one game as a record line
+    p1Mask, p2Mask, neutralMask = start
+    neutralA = (neutralMask & -neutralMask).bit_length() - 1
+    neutralB = (neutralMask & (neutralMask - 1)).bit_length() - 1
+    fields = [str(L_INDEX[p1Mask]), str(L_INDEX[p2Mask]), str(neutralA), str(neutralB), firstPlayer, winner or 'D']
+    fields.extend(encodeMove(*move) for move in moves)
+    return ' '.join(fields)
+
+
+def encodeMove(lMask, fromCell, toCell):
+    # one move in record notation
+    return str(L_INDEX[lMask]) if fromCell is None else f"{L_INDEX[lMask]}:{fromCell}-{toCell}"
+
+
+def placementMask(index):
+    # l mask for a placement index, python would read a negative one from the end
+    if not 0 <= index < len(L_MASKS):
+        raise IndexError("placement index out of range")
+    return L_MASKS[index]
+
+
+def decodeMove(field):
+    # record notation back to (l mask, neutral from cell, neutral to cell)
+    lIndex, _, neutral = field.partition(':')
+    try:
+        lMask = placementMask(int(lIndex))
+        if not neutral:
+            return lMask, None, None
+        fromCell, toCell = neutral.split('-')
+        fromCell, toCell = int(fromCell), int(toCell)
+    except (ValueError, IndexError):
+        raise ValueError("Invalid Move")
+    if not (0 <= fromCell < BOARD_SIZE * BOARD_SIZE and 0 <= toCell < BOARD_SIZE * BOARD_SIZE):
+        raise ValueError("Invalid Move")
+    return lMask, fromCell, toCell
+
+
+def decodeGameRecord(line):
+    # record line back to (start masks, first player, winner, moves)
+    fields = line.split()
+    start = (placementMask(int(fields[0])), placementMask(int(fields[1])), (1 << int(fields[2])) | (1 << int(fields[3])))
+    winner = None if fields[5] == 'D' else fields[5]
+    moves = [decodeMove(field) for field in fields[6:]]
+    return start, fields[4], winner, moves
+
+
+# state of a self play worker process, one game object is reused so its caches stay warm
+SELFPLAY_WORKER = {}
+
+
+def initSelfPlayWorker(engines, maxPlies, cacheSize, useTablebase):
+    # set up the game a worker keeps for all of its games
+    game = LGame(cacheSize)
+    if not useTablebase:
+        game.tablebase = None
+    SELFPLAY_WORKER['game'] = game
+    SELFPLAY_WORKER['engines'] = engines
+    SELFPLAY_WORKER['maxPlies'] = maxPlies
+
 
-    def restoreState(self, originalGrid, originalP1Pos, originalP2Pos):
-        # restore board and positions to previous state
-        for i in range(4):
-            for j in range(4):
-                self.grid[i][j] = originalGrid[i][j]
-        self.p1Pos = originalP1Pos[:]
-        self.p2Pos = originalP2Pos[:]
+def playSelfPlayGame(start):
+    # play one game in a worker and return its record line
+    game = SELFPLAY_WORKER['game']
+    p1Mask, p2Mask, neutralMask, firstPlayer = start
+    game.setPositionMasks(p1Mask, p2Mask, neutralMask, firstPlayer)
+    game.hasNeutralPlan = False
+    moves = []
+    winner, _ = playEngineGame(game, SELFPLAY_WORKER['engines'], SELFPLAY_WORKER['maxPlies'], moves)
+    return encodeGameRecord((p1Mask, p2Mask, neutralMask), firstPlayer, winner, moves)
+
+
+def runSelfPlay(games, engines, workers, path, maxPlies, seed, cacheSize=1 << 16, useTablebase=False):
+    # play games across a process pool and append their records to path
+    starts = [(p1Mask, p2Mask, neutralMask, 'L1' if i % 2 == 0 else 'L2')
+              for i, (p1Mask, p2Mask, neutralMask) in enumerate(randomStartPositions(games, seed))]
+    initArgs = (engines, maxPlies, cacheSize, useTablebase)
+    counts = {'L1': 0, 'L2': 0, 'D': 0}
+    plies = 0
+    start = time.perf_counter()
+    with open(path, 'a') as out:
+        if workers <= 1:
+            initSelfPlayWorker(*initArgs)
+            records = map(playSelfPlayGame, starts)
+            pool = None
+        else:
+            pool = ProcessPoolExecutor(workers, initializer=initSelfPlayWorker, initargs=initArgs)
+            records = pool.map(playSelfPlayGame, starts, chunksize=max(1, games // (workers * 8)))
+        try:
+            for record in records:
+                out.write(record + '\n')
+                fields = record.split(' ', 6)
+                counts[fields[5]] += 1
+                plies += len(record.split()) - 6
+        finally:
+            if pool is not None:
+                pool.shutdown()
+    elapsed = time.perf_counter() - start
+    return {
+        'games': games,
+        'seconds': elapsed,
+        'gamesPerSec': games / elapsed if elapsed else 0.0,
+        'wins': {'L1': counts['L1'], 'L2': counts['L2']},
+        'draws': counts['D'],
+        'averagePlies': plies / games if games else 0.0,
+    }
+
+
+def parseEngine(spec):
+    # 'full:3' or 'twostage:8' with an optional time limit in ms, 'full:32:50'
+    parts = spec.split(':')
+    if parts[0] not in ('full', 'twostage') or len(parts) not in (2, 3):
+        raise argparse.ArgumentTypeError(f"bad engine {spec}, expected mode:depth[:ms]")
+    try:
+        depth = int(parts[1])
+        timeLimit = int(parts[2]) / 1000 if len(parts) == 3 else None
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"bad engine {spec}, expected mode:depth[:ms]")
+    if depth < 1:
+        raise argparse.ArgumentTypeError(f"bad engine {spec}, depth must be at least 1")
+    return parts[0], depth, timeLimit
+
+
+# game analysis: records are replayed in worker processes that each keep one
+# warm game, and annotated games are streamed out one json line per game
+ANALYSIS_WORKER = {}
+RESULT_NAMES = {RESULT_WIN: 'win', RESULT_LOSS: 'loss', RESULT_DRAW: 'draw'}
+
+
+def initAnalysisWorker(depth, timeLimit, cacheSize, useTablebase):
+    # set up the game an analysis worker reuses, the search never reads the
+    # tablebase so the scores are the engine's own
+    game = LGame(cacheSize)
+    ANALYSIS_WORKER['tablebase'] = game.tablebase if useTablebase else None
+    game.tablebase = None
+    game.searchMode = 'full'
+    game.timeLimit = timeLimit
+    ANALYSIS_WORKER['game'] = game
+    ANALYSIS_WORKER['depth'] = depth
+
+
+def analyseGameRecord(item):
+    # replay one (line number, record line) and annotate every move with the
+    # best move and both scores from the mover's side, returns one json line
+    lineNumber, line = item
+    game = ANALYSIS_WORKER['game']
+    tablebase = ANALYSIS_WORKER['tablebase']
+    try:
+        start, firstPlayer, winner, moves = decodeGameRecord(line)
+        game.setPosition(Position.fromMasks(*start, firstPlayer))
+    except (ValueError, IndexError):
+        return json.dumps({'line': lineNumber, 'error': 'Invalid Record'})
+    game.undoStack.clear()
+    annotated = []
+    for ply, (lMask, fromCell, toCell) in enumerate(moves):
+        player = game.currentPlayer
+        ownMask, blocked = game.playerMasks(player)
+        oppMask = blocked & ~game.neutralMask
+        played = (lMask, game.neutralMask if fromCell is None else game.neutralMask ^ (1 << fromCell) ^ (1 << toCell))
+        if not isFullMoveLegal(ownMask, oppMask, game.neutralMask, played):
+            return json.dumps({'line': lineNumber, 'error': f'Illegal Move at ply {ply}'})
+        game.chooseAiMoveMinimax(game.genLegalMoves(player), player, ANALYSIS_WORKER['depth'])
+        best = game.bestFullMove
+        depth = max(game.completedDepth, 1)
+        sign = 1 if player == 'L2' else -1
+        bestScore = sign * game.scoreFullMove(player, best, depth)
+        playedScore = bestScore if played == best else sign * game.scoreFullMove(player, played, depth)
+        note = {
+            'ply': ply,
+            'player': player,
+            'played': encodeMove(lMask, fromCell, toCell),
+            'best': encodeMove(best[0], *neutralCells(game.neutralMask, best[1])),
+            'score': bestScore,
+            'playedScore': playedScore,
+            'depth': depth,
+        }
+        if tablebase is not None:
+            res, dist = tablebase.probe(ownMask, oppMask, game.neutralMask)
+            note['tablebase'] = f"{RESULT_NAMES[res]} {dist}"
+        annotated.append(note)
+        neutralMove = None
+        if fromCell is not None:
+            neutralMove = (game.neutralPieces.index(divmod(fromCell, BOARD_SIZE)),) + divmod(toCell, BOARD_SIZE)
+        game.makeGameMove(player, list(L_PLACEMENTS[L_INDEX[lMask]]), neutralMove)
+        game.currentPlayer = 'L2' if player == 'L1' else 'L1'
+    return json.dumps({'line': lineNumber, 'start': ' '.join(line.split()[:5]), 'winner': winner or 'D', 'moves': annotated})
+
+
+def readGameRecords(lines):
+    # (line number, record) for every non blank line, read lazily
+    for lineNumber, line in enumerate(lines, 1):
+        if line.strip():
+            yield lineNumber, line
+
+
+def boundedMap(pool, function, items, window):
+    # pool.map that keeps at most window items in flight, so a long input
+    # never sits in memory all at once, results come back in input order
+    pending = deque()
+    for item in items:
+        pending.append(pool.submit(function, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def analyseGames(lines, depth, timeLimit=None, workers=1, cacheSize=1 << 16, useTablebase=False):
+    # annotated json lines for the records in lines, in order
+    initArgs = (depth, timeLimit, cacheSize, useTablebase)
+    records = readGameRecords(lines)
+    if workers <= 1:
+        initAnalysisWorker(*initArgs)
+        yield from map(analyseGameRecord, records)
+        return
+    with ProcessPoolExecutor(workers, initializer=initAnalysisWorker, initargs=initArgs) as pool:
+        yield from boundedMap(pool, analyseGameRecord, records, workers * 4)
+
+
+# position evaluation: custom starting positions in the edit menu format are
+# searched in the same kind of worker as game analysis, a few lines per task,
+# one json line out per position
+EVALUATE_CHUNK = 8
+
+
+def evaluatePosition(item):
+    # search one (line number, '10 fields [L1|L2]') and return a json line with
+    # the best move, its score from the mover's side and the nodes searched
+    lineNumber, line = item
+    game = ANALYSIS_WORKER['game']
+    tablebase = ANALYSIS_WORKER['tablebase']
+    parts = line.split()
+    player = parts.pop() if len(parts) == 11 and parts[10] in ('L1', 'L2') else 'L1'
+    position = ' '.join(parts)
+    try:
+        p1Mask, p2Mask, neutralMask = parseInitialState(position)
+    except ValueError as error:
+        return json.dumps({'line': lineNumber, 'error': str(error)})
+    game.setPositionMasks(p1Mask, p2Mask, neutralMask, player)
+    result = {'line': lineNumber, 'position': position, 'player': player}
+    if not game.hasLegalMove(player):
+        # already lost, there is nothing to search
+        result.update({'best': None, 'score': -WIN_SCORE, 'nodes': 0, 'depth': 0, 'ms': 0})
+    else:
+        # the result must not depend on which worker got the line or what it searched before
+        game.clearSearchState()
+        game.chooseAiMoveMinimax(game.genLegalMoves(player), player, ANALYSIS_WORKER['depth'])
+        stats = game.lastSearchStats
+        best = game.bestFullMove
+        sign = 1 if player == 'L2' else -1
+        result.update({
+            'best': encodeMove(best[0], *neutralCells(neutralMask, best[1])),
+            'score': None if game.bestFullValue is None else sign * game.bestFullValue,
+            'nodes': stats.nodes,
+            'depth': stats.completedDepth,
+            'ms': round(stats.seconds * 1000, 3),
+        })
+    if tablebase is not None:
+        ownMask, blocked = game.playerMasks(player)
+        res, dist = tablebase.probe(ownMask, blocked & ~neutralMask, neutralMask)
+        result['tablebase'] = f"{RESULT_NAMES[res]} {dist}"
+    return json.dumps(result)
+
+
+def evaluatePositionChunk(items):
+    # evaluatePosition for a few lines at once, a shallow search costs less than
+    # the round trip to the worker
+    return [evaluatePosition(item) for item in items]
+
+
+def chunked(items, size):
+    # lists of up to size items, read lazily
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def evaluatePositions(lines, depth, timeLimit=None, workers=1, cacheSize=1 << 16, useTablebase=False):
+    # json lines for the positions in lines, in order
+    initArgs = (depth, timeLimit, cacheSize, useTablebase)
+    positions = readGameRecords(lines)
+    if workers <= 1:
+        initAnalysisWorker(*initArgs)
+        yield from map(evaluatePosition, positions)
+        return
+    with ProcessPoolExecutor(workers, initializer=initAnalysisWorker, initargs=initArgs) as pool:
+        for results in boundedMap(pool, evaluatePositionChunk, chunked(positions, EVALUATE_CHUNK), workers * 4):
+            yield from results
+
+
+def randomStartPositions(count, seed):
+    # positions where both players still have an l move
+    rng = random.Random(seed)
+    positions = [(own, opp, neutralMask) for own, opp, neutralMask in genAllPositions()
+                 if countLegalPlacements(own, opp | neutralMask) and countLegalPlacements(opp, own | neutralMask)]
+    if count > len(positions):
+        return rng.choices(positions, k=count)
+    return rng.sample(positions, count)
+
+
+def compareSearchModes(fullDepth, twoStageDepth, games, seed, maxPlies=80, cacheSize=1 << 16):
+    # nodes/sec and head to head results of full move search against the two stage search
+    starts = randomStartPositions(games, seed)
+    engines = {'full': ('full', fullDepth, None), 'twostage': ('twostage', twoStageDepth, None)}
+    speed = {}
+    for name, (mode, depth, _) in engines.items():
+        nodes = 0
+        elapsed = 0.0
+        probes = 0
+        hits = 0
+        collisions = 0
+        for p1Mask, p2Mask, neutralMask in starts:
+            game = LGame(cacheSize)
+            game.tablebase = None
+            game.searchMode = mode
+            game.setPositionMasks(p1Mask, p2Mask, neutralMask, 'L1')
+            start = time.perf_counter()
+            game.chooseAiMoveMinimax(game.genLegalMoves('L1'), 'L1', depth)
+            elapsed += time.perf_counter() - start
+            nodes += game.nodes
+            stats = (game.cache if mode == 'full' else game.twoStageCache).stats()
+            probes += stats['probes']
+            hits += stats['hits']
+            collisions += stats['collisions']
+        speed[name] = (nodes, elapsed, hits / probes if probes else 0.0, collisions)
+    score = {'win': 0, 'draw': 0, 'loss': 0}
+    for p1Mask, p2Mask, neutralMask in starts:
+        # every start is played twice so each engine gets both sides
+        for fullPlayer in ('L1', 'L2'):
+            twoStagePlayer = 'L2' if fullPlayer == 'L1' else 'L1'
+            game = LGame(cacheSize)
+            game.tablebase = None
+            game.setPositionMasks(p1Mask, p2Mask, neutralMask, 'L1')
+            winner, _ = playEngineGame(game, {fullPlayer: engines['full'], twoStagePlayer: engines['twostage']}, maxPlies)
+            if winner is None:
+                score['draw'] += 1
+            elif winner == fullPlayer:
+                score['win'] += 1
+            else:
+                score['loss'] += 1
+    return speed, score
+
+
+# fixed positions for benchmarks, None is the normal starting layout and the
+# rest use the editInitialState format, l1 moves first in all of them
+BENCH_POSITIONS = [
+    ('start', None),
+    ('open', '1 2 n 2 1 2 4 1 3 s'),
+    ('win5', '2 2 w 1 3 3 4 4 2 w'),
+    ('win9', '2 4 e 1 2 1 4 4 2 w'),
+    ('loss8', '1 4 e 4 2 3 1 2 3 n'),
+]
+
+
+def benchGame(position, cacheSize=1 << 16):
+    # fresh game set up at a benchmark position, the tablebase is left out
+    game = LGame(cacheSize)
+    game.tablebase = None
+    if position is not None:
+        game.setPositionMasks(*parseInitialState(position), 'L1')
+    return game
+
+
+def benchCase(kind, game, depth):
+    # run one benchmark case, returns (nodes, move chosen by a search)
+    if kind == 'perft':
+        return game.perft('L1', depth), None
+    if kind == 'fullPerft':
+        return game.fullPerft('L1', depth), None
+    move = game.chooseAiMoveMinimax(game.genLegalMoves('L1'), 'L1', depth)
+    return game.nodes, move
+
+
+def runBenchmark(searchDepths=(1, 2, 3, 4), perftDepth=5, fullPerftDepth=2, repeat=3, positions=BENCH_POSITIONS):
+    # best of repeat timed runs per case on a fresh game each time, then one
+    # more run under tracemalloc for the peak memory including the game itself
+    cases = []
+    for name, position in positions:
+        cases.append(('perft', name, position, perftDepth))
+        cases.append(('fullPerft', name, position, fullPerftDepth))
+        for depth in searchDepths:
+            cases.append(('search', name, position, depth))
+    results = []
+    for kind, name, position, depth in cases:
+        elapsed = math.inf
+        for _ in range(repeat):
+            game = benchGame(position)
+            start = time.perf_counter()
+            nodes, move = benchCase(kind, game, depth)
+            elapsed = min(elapsed, time.perf_counter() - start)
+        tracemalloc.start()
+        benchCase(kind, benchGame(position), depth)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result = {
+            'kind': kind,
+            'position': name,
+            'depth': depth,
+            'nodes': nodes,
+            'seconds': round(elapsed, 6),
+            'nps': round(nodes / elapsed) if elapsed else 0,
+            'peakBytes': peak,
+        }
+        if move is not None:
+            result['move'] = move
+        results.append(result)
+    return {
+        'benchmark': 'L-game',
+        'python': platform.python_version(),
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+def compareBenchmarks(current, baseline, tolerance):
+    # differences that count as regressions: changed node counts, or nps more than tolerance below the baseline
+    old = {(r['kind'], r['position'], r['depth']): r for r in baseline['results']}
+    problems = []
+    for result in current['results']:
+        key = (result['kind'], result['position'], result['depth'])
+        if key not in old:
+            continue
+        if result['nodes'] != old[key]['nodes']:
+            problems.append(f"{key}: nodes {old[key]['nodes']} -> {result['nodes']}")
+        elif result['nps'] < old[key]['nps'] * (1 - tolerance):
+            problems.append(f"{key}: nps {old[key]['nps']} -> {result['nps']}")
+    return problems
+
+
+
+SCALE_SEARCHES = (('full', 1, None), ('full', 2, None), ('twostage', 6, None), ('twostage', 8, None))
+
+
+def scaleGame(size, mode, cacheSize):
+    # fresh game at the start position of a board size, the tablebase is left
+    # out like in benchGame so every size is measured by search alone
+    game = LGame(cacheSize, size=size)
+    game.tablebase = None
+    game.searchMode = mode
+    return game
+
+
+def runScaleBenchmark(sizes=(4, 5, 6), searches=SCALE_SEARCHES, repeat=3, cacheSize=1 << 16):
+    # how speed and memory grow with the board: building the tables, then timed
+    # searches from each board's start position, best of repeat like runBenchmark
+    results = []
+    for size in sizes:
+        tracemalloc.start()
+        start = time.perf_counter()
+        board = Board(size)
+        buildSeconds = time.perf_counter() - start
+        tableBytes, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        startGame = scaleGame(size, 'full', cacheSize)
+        result = {
+            'size': size,
+            'placements': len(board.lMasks),
+            'startMoves': len(startGame.genPlayerFullMoves('L1')),
+            'buildSeconds': round(buildSeconds, 6),
+            'tableBytes': tableBytes,
+            'searches': [],
+        }
+        for mode, depth, _ in searches:
+            elapsed = math.inf
+            for _ in range(repeat):
+                game = scaleGame(size, mode, cacheSize)
+                begin = time.perf_counter()
+                move = game.chooseAiMoveMinimax(game.genLegalMoves('L1'), 'L1', depth)
+                elapsed = min(elapsed, time.perf_counter() - begin)
+            game = scaleGame(size, mode, cacheSize)
+            tracemalloc.start()
+            game.chooseAiMoveMinimax(game.genLegalMoves('L1'), 'L1', depth)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            result['searches'].append({
+                'mode': mode,
+                'depth': depth,
+                'nodes': game.nodes,
+                'seconds': round(elapsed, 6),
+                'nps': round(game.nodes / elapsed) if elapsed else 0,
+                'peakBytes': peak,
+                'move': move,
+            })
+        results.append(result)
+    return {
+        'benchmark': 'L-game board sizes',
+        'python': platform.python_version(),
+        'repeat': repeat,
+        'results': results,
+    }
+
+# engine protocol: one command per line in, one reply line out
+#   isready                          -> readyok
+#   newgame                          -> ok, start position with L1 to move
+#   position start [L1|L2]           -> ok
+#   position <10 fields> [L1|L2]     -> ok, same format as Edit Starting State
+#   position index p1 p2 nA nB [L1|L2] -> ok, placement indexes and cells as in game records
+#   move <move>                      -> ok, move in record notation: l index[:from-to]
+#   undo                             -> ok, takes back the last move
+#   mode full|twostage               -> ok
+#   go [depth N] [movetime MS]       -> bestmove <move> depth D nodes N time MS, or bestmove none
+#   stats                            -> stats <json>
+#   show                             -> board <rows separated by /> player <side to move>
+#   quit
+# anything that goes wrong is answered with: error <message>
+# masks of the position LGame() starts from
+START_MASKS = (cellsToMask([(0, 0), (0, 1), (0, 2), (1, 0)]), cellsToMask([(3, 3), (3, 2), (3, 1), (2, 3)]),
+               cellsToMask([(1, 1), (2, 2)]))
+
+
+class EngineSession:
+    def __init__(self, game):
+        # the game, and with it the caches, lives as long as the session
+        self.game = game
+        self.game.p1Type = 'ai'
+        self.game.p2Type = 'ai'
+        self.games = 1
+        self.commands = 0
+
+    def command(self, line):
+        # handle one protocol line and return the reply
+        parts = line.split()
+        if not parts:
+            return None
+        self.commands += 1
+        name = parts[0].lower()
+        handler = getattr(self, 'cmd_' + name, None)
+        if handler is None:
+            return f"error Unknown command {name}"
+        try:
+            return handler(parts[1:])
+        except ValueError as error:
+            return f"error {error}"
+
+    def setPosition(self, masks, args):
+        # args are what follows the position, at most the player to move
+        if len(args) > 1:
+            raise ValueError("Invalid Format")
+        player = args[0].upper() if args else 'L1'
+        if player not in ('L1', 'L2'):
+            raise ValueError("Invalid Player")
+        position = Position.fromMasks(*masks, player)
+        self.game.setPosition(position)
+        self.game.undoStack.clear()
+        self.game.hasNeutralPlan = False
+
+    def cmd_isready(self, args):
+        return "readyok"
+
+    def cmd_newgame(self, args):
+        self.setPosition(START_MASKS, [])
+        self.games += 1
+        return "ok"
+
+    def cmd_position(self, args):
+        if not args:
+            raise ValueError("Invalid Format")
+        if args[0] == 'start':
+            self.setPosition(START_MASKS, args[1:])
+        elif args[0] == 'index':
+            try:
+                p1, p2, neutralA, neutralB = (int(field) for field in args[1:5])
+                masks = (placementMask(p1), placementMask(p2), (1 << neutralA) | (1 << neutralB))
+            except (ValueError, IndexError):
+                raise ValueError("Invalid Format")
+            self.setPosition(masks, args[5:])
+        else:
+            self.setPosition(parseInitialState(' '.join(args[:10])), args[10:])
+        return "ok"
+
+    def cmd_move(self, args):
+        if len(args) != 1:
+            raise ValueError("Invalid Format")
+        game = self.game
+        player = game.currentPlayer
+        lMask, fromCell, toCell = decodeMove(args[0])
+        ownMask, blocked = game.playerMasks(player)
+        newNeutrals = game.neutralMask
+        if fromCell is not None:
+            newNeutrals ^= (1 << fromCell) ^ (1 << toCell)
+        if not isFullMoveLegal(ownMask, blocked & ~game.neutralMask, game.neutralMask, (lMask, newNeutrals)):
+            raise ValueError("Illegal Move")
+        neutralMove = None
+        if newNeutrals != game.neutralMask:
+            neutralMove = (game.neutralPieces.index(divmod(fromCell, BOARD_SIZE)),) + divmod(toCell, BOARD_SIZE)
+        game.makeGameMove(player, list(L_PLACEMENTS[L_INDEX[lMask]]), neutralMove)
+        game.currentPlayer = 'L2' if player == 'L1' else 'L1'
+        game.hasNeutralPlan = False
+        return "ok"
+
+    def cmd_undo(self, args):
+        game = self.game
+        if not game.undoStack:
+            raise ValueError("Nothing To Undo")
+        game.unmakeGameMove()
+        game.currentPlayer = 'L2' if game.currentPlayer == 'L1' else 'L1'
+        game.hasNeutralPlan = False
+        return "ok"
+
+    def cmd_mode(self, args):
+        if len(args) != 1 or args[0] not in ('full', 'twostage'):
+            raise ValueError("Unknown mode")
+        self.game.searchMode = args[0]
+        return "ok"
+
+    def cmd_go(self, args):
+        move, seconds = self.search(*self.goOptions(args))
+        stats = self.game.lastSearchStats
+        return self.bestMoveReply(move, stats.completedDepth, stats.nodes, seconds)
+
+    def goOptions(self, args):
+        # (depth, time limit in seconds) from the arguments of go
+        try:
+            options = dict(zip(args[::2], (int(value) for value in args[1::2])))
+        except ValueError:
+            raise ValueError("Invalid Format")
+        if len(args) % 2 or not set(options) <= {'depth', 'movetime'}:
+            raise ValueError("Invalid Format")
+        depth = options.get('depth')
+        moveTime = options.get('movetime')
+        if depth is None:
+            depth = MAX_SEARCH_DEPTH if moveTime is not None else 3
+        elif depth < 1:
+            raise ValueError("Invalid Format")
+        depth = min(depth, MAX_SEARCH_DEPTH)
+        return depth, None if moveTime is None else moveTime / 1000
+
+    def bestMoveReply(self, move, depth, nodes, seconds):
+        if move is None:
+            return "bestmove none"
+        return f"bestmove {move} depth {depth} nodes {nodes} time {round(seconds * 1000)}"
+
+    def search(self, depth, timeLimit):
+        # best move for the side to move in record notation, the board is left as it was
+        game = self.game
+        player = game.currentPlayer
+        legalMoves = game.genLegalMoves(player)
+        if not legalMoves:
+            return None, 0.0
+        start = time.perf_counter()
+        game.timeLimit = timeLimit
+        cells = game.chooseAiMoveMinimax(legalMoves, player, depth)
+        oldNeutrals = game.neutralMask
+        game.makeGameMove(player, cells)
+        neutralMove = game.chooseAiNeutralMove()
+        newNeutrals = oldNeutrals
+        if neutralMove is not None:
+            index, x, y = neutralMove
+            newNeutrals = oldNeutrals ^ cellBit(*game.neutralPieces[index]) ^ cellBit(x, y)
+        game.unmakeGameMove()
+        return encodeMove(cellsToMask(cells), *neutralCells(oldNeutrals, newNeutrals)), time.perf_counter() - start
+
+    def cmd_stats(self, args):
+        report = {
+            'search': self.game.lastSearchStats.asDict(),
+            'cache': (self.game.cache if self.game.searchMode == 'full' else self.game.twoStageCache).stats(),
+            'games': self.games,
+            'commands': self.commands,
+        }
+        return "stats " + json.dumps(report, separators=(',', ':'))
+
+    def cmd_show(self, args):
+        rows = '/'.join(' '.join(row) for row in self.game.grid)
+        return f"board {rows} player {self.game.currentPlayer}"
+
+
+def runEngine(game, lines=sys.stdin, out=sys.stdout):
+    # serve the engine protocol until quit or end of input
+    session = EngineSession(game)
+    for line in lines:
+        if line.split()[:1] == ['quit']:
+            break
+        reply = session.command(line)
+        if reply is not None:
+            out.write(reply + '\n')
+            out.flush()
+    game.close()
+
+
+# game server: every connection is one EngineSession on a small game, the
+# searches run in worker processes that each keep one warm game
+SEARCH_WORKER = {}
+LATENCY_SAMPLES = 10000
+# connections the listening socket holds before they are accepted
+SERVER_BACKLOG = 1024
+# time limit in ms for a go without movetime, and the most any go may ask for,
+# so one client cannot keep a worker busy indefinitely
+SERVER_MOVETIME = 1000
+SERVER_MAX_MOVETIME = 10000
+
+
+def initSearchWorker(cacheSize, useTablebase):
+    # set up the session a search worker reuses for every request
+    # ctrl-c is for the server, it shuts the pool down itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    game = LGame(cacheSize)
+    if not useTablebase:
+        game.tablebase = None
+    SEARCH_WORKER['session'] = EngineSession(game)
+
+
+def searchPacked(packed, mode, depth, timeLimit):
+    # search a Position.packed in a worker, returns (move, depth, nodes, seconds)
+    session = SEARCH_WORKER['session']
+    session.game.setPosition(Position(packed))
+    session.game.searchMode = mode
+    move, seconds = session.search(depth, timeLimit)
+    stats = session.game.lastSearchStats
+    return move, stats.completedDepth, stats.nodes, seconds
+
+
+def percentiles(samples):
+    # latency summary in milliseconds
+    ordered = sorted(samples)
+    if not ordered:
+        return {'count': 0}
+    pick = lambda q: round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 3)
+    return {'count': len(ordered), 'p50': pick(0.5), 'p90': pick(0.9), 'p99': pick(0.99), 'max': pick(1.0)}
+
+
+class GameServer:
+    def __init__(self, workers, maxQueue, cacheSize=1 << 16, useTablebase=False,
+                 moveTime=SERVER_MOVETIME, maxMoveTime=SERVER_MAX_MOVETIME):
+        # the pool is started, and the tables it inherits are built, before any client connects
+        self.workers = workers
+        self.maxQueue = maxQueue
+        # every search in the pool runs under a time limit, in seconds
+        self.moveTime = moveTime / 1000
+        self.maxMoveTime = maxMoveTime / 1000
+        self.pool = ProcessPoolExecutor(workers, initializer=initSearchWorker, initargs=(cacheSize, useTablebase))
+        # one trivial job per worker makes them all start now
+        list(self.pool.map(abs, range(workers)))
+        self.useTablebase = useTablebase
+        self.slots = None
+        # searches waiting or running, over maxQueue new ones are turned away
+        self.queued = 0
+        self.sessions = 0
+        self.requests = 0
+        self.busy = 0
+        self.latencies = {}
+
+    async def go(self, session, args):
+        # run go in the pool, at most one search per worker at a time
+        depth, timeLimit = session.goOptions(args)
+        timeLimit = min(self.moveTime if timeLimit is None else timeLimit, self.maxMoveTime)
+        if self.queued >= self.maxQueue:
+            self.busy += 1
+            return "error busy"
+        game = session.game
+        self.queued += 1
+        try:
+            async with self.slots:
+                loop = asyncio.get_running_loop()
+                result = await loop.run_in_executor(self.pool, searchPacked, game.toPosition().packed,
+                                                    game.searchMode, depth, timeLimit)
+        except Exception as error:
+            # a search that failed in the worker, or a broken pool, is answered
+            # like any other error and the connection stays up
+            return f"error {error or type(error).__name__}"
+        finally:
+            self.queued -= 1
+        return session.bestMoveReply(*result)
+
+    def stats(self):
+        return {
+            'sessions': self.sessions,
+            'queued': self.queued,
+            'requests': self.requests,
+            'busy': self.busy,
+            'latency': {name: percentiles(samples) for name, samples in self.latencies.items()},
+        }
+
+    async def handleClient(self, reader, writer):
+        # one session per connection, commands are answered in order
+        game = LGame(1)
+        if not self.useTablebase:
+            game.tablebase = None
+        session = EngineSession(game)
+        self.sessions += 1
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                start = time.perf_counter()
+                text = line.decode(errors='replace')
+                parts = text.split()
+                name = parts[0].lower() if parts else ''
+                if name == 'quit':
+                    break
+                if name == 'go':
+                    try:
+                        reply = await self.go(session, parts[1:])
+                    except ValueError as error:
+                        reply = f"error {error}"
+                elif name == 'stats':
+                    reply = "stats " + json.dumps(self.stats(), separators=(',', ':'))
+                else:
+                    reply = session.command(text)
+                if reply is not None:
+                    writer.write((reply + '\n').encode())
+                    await writer.drain()
+                self.requests += 1
+                if name:
+                    samples = self.latencies.setdefault(name, deque(maxlen=LATENCY_SAMPLES))
+                    samples.append(time.perf_counter() - start)
+        except ConnectionError:
+            pass
+        finally:
+            self.sessions -= 1
+            writer.close()
+
+    async def serve(self, host=None, port=None, path=None):
+        # listen on a unix socket when a path is given, tcp otherwise, until ctrl-c or sigterm
+        self.slots = asyncio.Semaphore(self.workers)
+        if path is not None:
+            server = await asyncio.start_unix_server(self.handleClient, path=path, backlog=SERVER_BACKLOG)
+        else:
+            server = await asyncio.start_server(self.handleClient, host, port, backlog=SERVER_BACKLOG)
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signum, stop.set)
+            except (NotImplementedError, AttributeError):
+                # no signal handlers in the windows event loop, ctrl-c still ends asyncio.run
+                pass
+        async with server:
+            await stop.wait()
+
+    def close(self):
+        self.pool.shutdown(cancel_futures=True)
+
+
+def runCommand(argv):
+    # non interactive commands
+    parser = argparse.ArgumentParser(prog='L-game.py')
+    commands = parser.add_subparsers(dest='command', required=True)
+    solve = commands.add_parser('solve', help='solve every position and write the tablebase')
+    solve.add_argument('--file', default=TABLEBASE_PATH)
+    verify = commands.add_parser('verify', help='check the tablebase file')
+    verify.add_argument('--file', default=TABLEBASE_PATH)
+    compare = commands.add_parser('compare', help='benchmark full move search against the two stage search')
+    compare.add_argument('--full-depth', type=int, default=3)
+    compare.add_argument('--twostage-depth', type=int, default=8)
+    compare.add_argument('--games', type=int, default=20)
+    compare.add_argument('--seed', type=int, default=1)
+    compare.add_argument('--cache-size', type=int, default=1 << 16)
+    selfplay = commands.add_parser('selfplay', help='play ai vs ai games across processes and record them')
+    selfplay.add_argument('--games', type=int, default=100)
+    selfplay.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    selfplay.add_argument('--p1', type=parseEngine, default=('full', 2, None), help='mode:depth[:ms], e.g. full:3 or twostage:8')
+    selfplay.add_argument('--p2', type=parseEngine, default=('full', 2, None))
+    selfplay.add_argument('--max-plies', type=int, default=60)
+    selfplay.add_argument('--seed', type=int, default=1)
+    selfplay.add_argument('--cache-size', type=int, default=1 << 16)
+    selfplay.add_argument('--tablebase', action='store_true', help='let the engines use lgame.tb')
+    selfplay.add_argument('--out', default='games.lgr')
+    bench = commands.add_parser('bench', help='perft and timed searches on fixed positions, as json')
+    bench.add_argument('--depths', default='1,2,3,4', help='search depths, comma separated')
+    bench.add_argument('--perft-depth', type=int, default=5)
+    bench.add_argument('--full-perft-depth', type=int, default=2)
+    bench.add_argument('--repeat', type=int, default=5, help='timed runs per case, the fastest counts')
+    bench.add_argument('--out', help='write the json here instead of stdout')
+    bench.add_argument('--baseline', help='json from an earlier run to check for regressions')
+    bench.add_argument('--tolerance', type=float, default=0.25, help='allowed nps drop against the baseline')
+    scale = commands.add_parser('scale', help='table size and search speed on bigger boards, as json')
+    scale.add_argument('--sizes', default='4,5,6', help='board sizes, comma separated')
+    scale.add_argument('--searches', default='full:1,full:2,twostage:6,twostage:8', help='mode:depth list, comma separated')
+    scale.add_argument('--repeat', type=int, default=3, help='timed runs per search, the fastest counts')
+    scale.add_argument('--out', help='write the json here instead of stdout')
+    play = commands.add_parser('play', help='play interactively on a board of any size')
+    play.add_argument('--size', type=int, default=BOARD_SIZE)
+    stats = commands.add_parser('stats', help='search one position and print what the search did, as json')
+    stats.add_argument('--position', help='10 field position like the edit menu takes, default is the start')
+    stats.add_argument('--player', choices=('L1', 'L2'), default='L1')
+    stats.add_argument('--mode', choices=('full', 'twostage'), default='full')
+    stats.add_argument('--depth', type=int, default=4)
+    stats.add_argument('--time-ms', type=int, help='time limit for the move')
+    stats.add_argument('--tablebase', action='store_true', help='let the search use lgame.tb')
+    stats.add_argument('--profile', help='also run the search under cProfile and dump it here')
+    stats.add_argument('--workers', type=int, default=1, help='processes to split the root moves over')
+    evaluate = commands.add_parser('evaluate', help='search positions in the edit menu format, one json line per position')
+    evaluate.add_argument('--in', dest='source', default='-', help='one position per line, 10 fields and an optional L1/L2, - for stdin')
+    evaluate.add_argument('--out', help='write here instead of stdout')
+    evaluate.add_argument('--depth', type=int, default=4)
+    evaluate.add_argument('--time-ms', type=int, help='time limit per position')
+    evaluate.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    evaluate.add_argument('--cache-size', type=int, default=1 << 16)
+    evaluate.add_argument('--tablebase', action='store_true', help='add the tablebase result of every position')
+    analyse = commands.add_parser('analyse', help='annotate recorded games with the engine\'s scores, one json line per game')
+    analyse.add_argument('--in', dest='source', default='-', help='game records, - for stdin')
+    analyse.add_argument('--out', help='write here instead of stdout')
+    analyse.add_argument('--depth', type=int, default=3)
+    analyse.add_argument('--time-ms', type=int, help='time limit per move')
+    analyse.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    analyse.add_argument('--cache-size', type=int, default=1 << 16)
+    analyse.add_argument('--tablebase', action='store_true', help='add the tablebase result of every position')
+    commands.add_parser('checkeval', help='check the batch evaluator against heuristicEvaluation on every position')
+    engine = commands.add_parser('engine', help='long running engine speaking a line protocol on stdin/stdout')
+    engine.add_argument('--cache-size', type=int, default=1 << 16)
+    engine.add_argument('--workers', type=int, default=1, help='processes to split the root moves over')
+    engine.add_argument('--tablebase', action='store_true', help='let the engine use lgame.tb')
+    serve = commands.add_parser('serve', help='host many engine sessions over tcp or a unix socket')
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=7878)
+    serve.add_argument('--unix', help='listen on this unix socket instead of tcp')
+    serve.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='search processes')
+    serve.add_argument('--max-queue', type=int, default=256, help='searches waiting or running before go answers busy')
+    serve.add_argument('--cache-size', type=int, default=1 << 16, help='transposition table slots per search process')
+    serve.add_argument('--tablebase', action='store_true', help='let the searches use lgame.tb')
+    serve.add_argument('--movetime', type=int, default=SERVER_MOVETIME, help='time limit in ms for a go without movetime')
+    serve.add_argument('--max-movetime', type=int, default=SERVER_MAX_MOVETIME, help='longest time limit in ms a go may ask for')
+    args = parser.parse_args(argv)
+
+    if args.command == 'solve':
+        table = solveTablebase()
+        writeTablebase(table, args.file)
+        counts = {name: sum(1 for entry in table if entry >> 6 == res)
+                  for name, res in (('win', RESULT_WIN), ('loss', RESULT_LOSS), ('draw', RESULT_DRAW))}
+        print(f"wrote {args.file}: {sum(counts.values())} positions, {counts}")
+        return 0
+    if args.command == 'verify':
+        tablebase = Tablebase(args.file)
+        table = tablebase.table()
+        problems = verifyTablebase(table)
+        if table != solveTablebase():
+            problems.append('table differs from a fresh solve')
+        if problems:
+            print(f"{args.file}: {len(problems)} problems")
+            return 1
+        print(f"{args.file}: ok")
+        return 0
+    if args.command == 'compare':
+        speed, score = compareSearchModes(args.full_depth, args.twostage_depth, args.games, args.seed, cacheSize=args.cache_size)
+        for name, (nodes, elapsed, hitRate, collisions) in speed.items():
+            print(f"{name:9} {nodes:9} nodes {elapsed:8.3f}s {nodes / max(elapsed, 1e-9):10.0f} nodes/sec "
+                  f"cache hit rate {hitRate:.1%} collisions {collisions}")
+        print(f"full vs twostage over {2 * args.games} games: {score['win']} wins, {score['draw']} draws, {score['loss']} losses")
+        return 0
+    if args.command == 'selfplay':
+        report = runSelfPlay(args.games, {'L1': args.p1, 'L2': args.p2}, args.workers, args.out,
+                             args.max_plies, args.seed, args.cache_size, args.tablebase)
+        print(f"{report['games']} games in {report['seconds']:.2f}s ({report['gamesPerSec']:.1f} games/sec): "
+              f"L1 {report['wins']['L1']}, L2 {report['wins']['L2']}, draws {report['draws']}, "
+              f"{report['averagePlies']:.1f} plies per game, appended to {args.out}")
+        return 0
+    if args.command == 'bench':
+        depths = [int(depth) for depth in args.depths.split(',')]
+        report = runBenchmark(depths, args.perft_depth, args.full_perft_depth, args.repeat)
+        text = json.dumps(report, indent=2)
+        if args.out:
+            with open(args.out, 'w') as f:
+                f.write(text + '\n')
+        else:
+            print(text)
+        if args.baseline:
+            with open(args.baseline) as f:
+                problems = compareBenchmarks(report, json.load(f), args.tolerance)
+            for problem in problems:
+                print(f"regression {problem}", file=sys.stderr)
+            return 1 if problems else 0
+        return 0
+    if args.command == 'scale':
+        sizes = [int(size) for size in args.sizes.split(',')]
+        searches = [parseEngine(spec) for spec in args.searches.split(',')]
+        text = json.dumps(runScaleBenchmark(sizes, searches, args.repeat), indent=2)
+        if args.out:
+            with open(args.out, 'w') as f:
+                f.write(text + '\n')
+        else:
+            print(text)
+        return 0
+    if args.command == 'play':
+        if args.size < 4:
+            parser.error('--size must be at least 4')
+        LGame(size=args.size).startGame()
+        return 0
+    if args.command == 'stats':
+        game = benchGame(args.position)
+        if args.tablebase:
+            game.tablebase = loadTablebase()
+        game.currentPlayer = args.player
+        game.searchMode = args.mode
+        game.timeLimit = None if args.time_ms is None else args.time_ms / 1000
+        game.collectStats = True
+        game.profilePath = args.profile
+        game.workers = args.workers
+        try:
+            move = game.chooseAiMoveMinimax(game.genLegalMoves(args.player), args.player, args.depth)
+        finally:
+            game.close()
+        report = game.lastSearchStats.asDict()
+        report['move'] = None if move is None else L_INDEX[cellsToMask(move)]
+        print(json.dumps(report, indent=2))
+        return 0
+    if args.command == 'analyse':
+        source = sys.stdin if args.source == '-' else open(args.source)
+        out = sys.stdout if args.out is None else open(args.out, 'w')
+        try:
+            timeLimit = None if args.time_ms is None else args.time_ms / 1000
+            for annotated in analyseGames(source, args.depth, timeLimit, args.workers, args.cache_size, args.tablebase):
+                out.write(annotated + '\n')
+                out.flush()
+        finally:
+            if source is not sys.stdin:
+                source.close()
+            if out is not sys.stdout:
+                out.close()
+        return 0
+    if args.command == 'evaluate':
+        source = sys.stdin if args.source == '-' else open(args.source)
+        out = sys.stdout if args.out is None else open(args.out, 'w')
+        start = time.perf_counter()
+        count = 0
+        try:
+            timeLimit = None if args.time_ms is None else args.time_ms / 1000
+            for result in evaluatePositions(source, args.depth, timeLimit, args.workers, args.cache_size, args.tablebase):
+                out.write(result + '\n')
+                out.flush()
+                count += 1
+        finally:
+            if source is not sys.stdin:
+                source.close()
+            if out is not sys.stdout:
+                out.close()
+        seconds = time.perf_counter() - start
+        print(f"{count} positions in {seconds:.2f}s ({count / seconds if seconds else 0:.1f} positions/sec)", file=sys.stderr)
+        return 0
+    if args.command == 'checkeval':
+        game = LGame(1)
+        game.tablebase = None
+        game.currentPlayer = 'L1'
+        problems, referenceSeconds, batchSeconds = checkBatchEvaluation(game)
+        for problem in problems[:20]:
+            print(problem)
+        print(f"{POSITION_COUNT} positions, {len(problems)} problems, reference {referenceSeconds:.3f}s, "
+              f"batch {batchSeconds:.3f}s ({'numpy' if np is not None else 'no numpy'})")
+        return 1 if problems else 0
+    if args.command == 'engine':
+        game = LGame(args.cache_size, args.workers)
+        if not args.tablebase:
+            game.tablebase = None
+        runEngine(game)
+        return 0
+    if args.command == 'serve':
+        server = GameServer(args.workers, args.max_queue, args.cache_size, args.tablebase,
+                            args.movetime, args.max_movetime)
+        try:
+            asyncio.run(server.serve(args.host, args.port, args.unix))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            print(json.dumps(server.stats()), file=sys.stderr)
+        return 0
+    return 1
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        sys.exit(runCommand(sys.argv[1:]))
     game = LGame()
     game.startGame()